@@ -0,0 +1,518 @@
+import argparse
+import contextlib
+import datetime
+import io
+import ipaddress
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+try:
+    import chdb.session
+except ImportError:
+    chdb = None
+
+# Benchmarks for startup, the parser, the import, the exports and the graph API.
+#   python3 benchmark.py generate bench.log --lines 1000000
+#   python3 benchmark.py run bench.log --backend chdb -o results.json
+#   python3 benchmark.py compare before.json after.json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DATABASE = 'logger_bench'
+BENCH_BLOCK_LINES = 10000
+
+# (value, weight)
+bench_methods = (('GET', 80), ('POST', 14), ('HEAD', 3), ('PUT', 2), ('DELETE', 1))
+bench_protocols = (('HTTP/1.1', 80), ('HTTP/2.0', 15), ('HTTP/1.0', 5))
+bench_ok_statuses = ((200, 86), (304, 7), (301, 3), (302, 2), (206, 2))
+bench_error_statuses = ((404, 50), (500, 15), (403, 10), (400, 10), (502, 6), (503, 5), (401, 4))
+bench_user_agents = (
+    ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36', 40),
+    ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Safari/605.1.15', 15),
+    ('Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0', 10),
+    ('Mozilla/5.0 (iPhone; CPU iPhone OS 17_4 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4 Mobile/15E148 Safari/604.1', 15),
+    ('Mozilla/5.0 (Linux; Android 14; SM-S918B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Mobile Safari/537.36', 10),
+    ('Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)', 4),
+    ('Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)', 3),
+    ('curl/8.5.0', 2),
+    ('python-requests/2.31.0', 1),
+)
+bench_referrers = (
+    ('-', 50),
+    ('https://www.google.com/', 20),
+    ('https://yandex.ru/', 15),
+    ('https://example.com/', 10),
+    ('https://t.me/', 5),
+)
+bench_path_sections = ('api/v1/items', 'api/v1/users', 'catalog', 'news', 'static/js', 'static/css', 'images', 'search')
+bench_path_suffixes = {'static/js': '.js', 'static/css': '.css', 'images': '.png'}
+
+def weighted(choices):
+    values, weights = zip(*choices)
+    return values, list(itertools.accumulate(weights))
+
+def zipf_cum_weights(n, s=1.1):
+    # A few hot clients and pages, a long tail of rare ones
+    return list(itertools.accumulate(1 / i ** s for i in range(1, n + 1)))
+
+def generate_ips(rng, count):
+    ips = []
+    for i in range(count):
+        if i % 10 == 9:
+            # One address in ten is IPv6
+            ips.append(str(ipaddress.IPv6Address((0x20010db8 << 96) | rng.getrandbits(64))))
+        else:
+            ips.append(f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}")
+    return ips
+
+def generate_paths(rng, count):
+    paths = ['/']
+    for i in range(1, count):
+        section = rng.choice(bench_path_sections)
+        path = f"/{section}/{i}{bench_path_suffixes.get(section, '')}"
+        if section == 'search':
+            path += f"?q=term{rng.randint(1, 1000)}&page={rng.randint(1, 20)}"
+        paths.append(path)
+    return paths
+
+def generate_malformed(rng, ip, timestamp):
+    # What real logs contain besides regular requests: scanners, timeouts, broken lines
+    return rng.choice((
+        f'{ip} - - [{timestamp} +0300] "-" 408 0 "-" "-" 0\n',
+        f'{ip} - - [{timestamp} +0300] "\\x16\\x03\\x01" 400 226 "-" "-" 15\n',
+        f'{ip} - - [{timestamp} +0300] "GET /index.html HTTP/1.1" 200\n',
+        f'{ip} - - [{timestamp} +0300] "GET /index.html HTTP/1.1" 200 - "-" "-" 120\n',
+    ))
+
+def generate_log(file, lines, ips=10000, paths=1000, error_rate=0.05, malformed_rate=0.001,
+                 start=datetime.datetime(2024, 1, 1), days=30, seed=42):
+    # The same arguments always produce the same file
+    rng = random.Random(seed)
+    ip_values, ip_weights = generate_ips(rng, ips), zipf_cum_weights(ips)
+    path_values, path_weights = generate_paths(rng, paths), zipf_cum_weights(paths)
+    methods, method_weights = weighted(bench_methods)
+    protocols, protocol_weights = weighted(bench_protocols)
+    ok_statuses, ok_weights = weighted(bench_ok_statuses)
+    error_statuses, error_weights = weighted(bench_error_statuses)
+    user_agents, user_agent_weights = weighted(bench_user_agents)
+    referrers, referrer_weights = weighted(bench_referrers)
+    step = days * 86400 / max(lines, 1)
+    start_ts = start.timestamp()
+    timestamp_second, timestamp_text = None, None
+    for block_start in range(0, lines, BENCH_BLOCK_LINES):
+        n = min(BENCH_BLOCK_LINES, lines - block_start)
+        block = zip(
+            rng.choices(ip_values, cum_weights=ip_weights, k=n),
+            rng.choices(path_values, cum_weights=path_weights, k=n),
+            rng.choices(methods, cum_weights=method_weights, k=n),
+            rng.choices(protocols, cum_weights=protocol_weights, k=n),
+            rng.choices(user_agents, cum_weights=user_agent_weights, k=n),
+            rng.choices(referrers, cum_weights=referrer_weights, k=n),
+        )
+        out = []
+        for i, (ip, path, method, protocol, user_agent, referrer) in enumerate(block, start=block_start):
+            second = int(start_ts + i * step)
+            if second != timestamp_second:
+                timestamp_second = second
+                timestamp_text = datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+            if rng.random() < malformed_rate:
+                out.append(generate_malformed(rng, ip, timestamp_text))
+                continue
+            if rng.random() < error_rate:
+                status = rng.choices(error_statuses, cum_weights=error_weights)[0]
+            else:
+                status = rng.choices(ok_statuses, cum_weights=ok_weights)[0]
+            bytes_sent = 0 if status == 304 or method == 'HEAD' else int(rng.lognormvariate(8, 1.5))
+            response_time = int(rng.lognormvariate(10 if status >= 500 else 8, 1))
+            out.append(f'{ip} - - [{timestamp_text} +0300] "{method} {path} {protocol}" {status} {bytes_sent}'
+                       f' "{referrer}" "{user_agent}" {response_time}\n')
+        file.write(''.join(out))
+
+class ChdbClient:
+    # In-process stand-in for clickhouse_driver.Client on a chdb session, covering the calls logger.py makes.
+    # Query settings are only applied to SELECTs.
+    def __init__(self, session, lock):
+        self.session = session
+        self.lock = lock
+        self.last_query = None
+        self.connection = self
+        self.server_info = self
+
+    def force_connect(self):
+        pass
+
+    def get_timezone(self):
+        return self.query("SELECT timezone()").iloc[0, 0]
+
+    def disconnect(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def query(self, query, params=None, settings=None):
+        from clickhouse_driver.util.escape import escape_params
+        if params:
+            query = query % escape_params(params, self)
+        if settings and re.match(r'\s*(SELECT|WITH)\b', query, re.IGNORECASE):
+            query += " SETTINGS " + ", ".join(f"{name} = {value!r}" for name, value in settings.items())
+        with self.lock:
+            return self.session.query(query, 'DataFrame')
+
+    def insert(self, table, columns, settings=None):
+        # Columnar blocks go in as JSON, packed IPv6 addresses as text
+        ips = [str(ipaddress.IPv6Address(ip)) if isinstance(ip, bytes) else ip for ip in columns[0]]
+        data = json.dumps([ips, *map(list, columns[1:])], ensure_ascii=False)
+        query = f"INSERT INTO {table}"
+        if settings:
+            query += " SETTINGS " + ", ".join(f"{name} = {value!r}" for name, value in settings.items())
+        with self.lock:
+            self.session.query(f"{query} FORMAT JSONCompactColumns {data}")
+        return len(ips)
+
+    def execute(self, query, params=None, with_column_types=False, columnar=False, settings=None):
+        insert = re.fullmatch(r'\s*INSERT INTO (\w+) VALUES\s*', query)
+        if insert:
+            return self.insert(insert[1], params, settings)
+        df = self.query(query, params, settings)
+        columns = [(name, str(dtype)) for name, dtype in df.dtypes.items()]
+        data = [df[name].astype(object).tolist() for name in df.columns]
+        data = data if columnar else list(zip(*data))
+        return (data, columns) if with_column_types else data
+
+    def execute_with_progress(self, query, params=None, **kwargs):
+        result = self.execute(query, params, **kwargs)
+        class Progress(list):
+            def get_result(self):
+                return result
+        return Progress()
+
+class ChdbPool:
+    def __init__(self, client):
+        self.client_ = client
+
+    @contextlib.contextmanager
+    def client(self):
+        yield self.client_
+
+    def stats(self):
+        return {"size": 1, "created": 1, "idle": 1}
+
+def chdb_http_query(client):
+    def http_query(query, params=None, settings=None, query_id=None):
+        query, fmt = re.fullmatch(r'(?s)(.*?)\s+FORMAT\s+(\w+)\s*', query).groups()
+        if settings:
+            query += " SETTINGS " + ", ".join(f"{name} = {value!r}" for name, value in settings.items())
+        with client.lock:
+            result = client.session.query(query, fmt, params=params or {})
+        return io.BytesIO(result.bytes())
+    return http_query
+
+def schema_statements(database):
+    # The docker init scripts, in a database of their own
+    for name in sorted(os.listdir(os.path.join(BENCH_DIR, 'clickhouse-initdb'))):
+        with open(os.path.join(BENCH_DIR, 'clickhouse-initdb', name)) as file:
+            sql = re.sub(r'\blogger\b', database, file.read())
+        yield from (statement for statement in sql.split(';') if statement.strip())
+
+def backend_chdb(args):
+    if chdb is None:
+        print("The chdb backend needs the chdb package: `pip install chdb`.")
+        exit(1)
+    session = chdb.session.Session(args.chdb_path) if args.chdb_path else chdb.session.Session()
+    client = ChdbClient(session, threading.Lock())
+    for statement in schema_statements(BENCH_DATABASE):
+        client.execute(statement)
+    client.execute(f"USE {BENCH_DATABASE}")
+    import importer
+    import logger
+    logger.db_pool = ChdbPool(client)
+    logger.db_http_query = chdb_http_query(client)
+    return importer, logger, client
+
+def backend_clickhouse(args):
+    # A separate database on the configured server, so real data is never touched
+    os.environ['CHDB_DATABASE'] = BENCH_DATABASE
+    import clickhouse_driver
+    import importer
+    import logger
+    admin = clickhouse_driver.Client(host=importer.CHDB_HOST, port=importer.CHDB_PORT,
+                                     user=importer.CHDB_USER, password=importer.CHDB_PASSWORD)
+    for statement in schema_statements(BENCH_DATABASE):
+        admin.execute(statement)
+    admin.disconnect()
+    return importer, logger, importer.db_client('logger-bench')
+
+@contextlib.contextmanager
+def quiet():
+    # The parser prints a checkpoint line every 100k lines
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+class RssSampler(threading.Thread):
+    # Peak resident memory while a benchmark runs, from /proc/self/statm
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.baseline = self.peak = self.rss()
+
+    @staticmethod
+    def rss():
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, self.rss())
+
+def bench_startup(repeat):
+    # Fresh interpreters, as for a CLI run or a new web worker
+    commands = {
+        'importer': "import importer",
+        'web_app': "import logger; logger.create_app()",
+    }
+    results = {}
+    for name, command in commands.items():
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', command], cwd=BENCH_DIR, check=True)
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        results[name] = {
+            "p50_ms": statistics.median(timings) * 1000,
+            "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        }
+    return results
+
+def bench_stream(importer, path):
+    # The web import path: uploaded chunks -> iterable_to_stream -> text lines
+    def chunks():
+        with open(path, 'rb') as file:
+            while chunk := file.read(importer.IMPORT_READ_SIZE):
+                yield chunk
+    started = time.perf_counter()
+    stream = importer.iterable_to_stream(chunks(), buffer_size=importer.IMPORT_READ_SIZE)
+    lines = sum(1 for _ in io.TextIOWrapper(stream))
+    elapsed = time.perf_counter() - started
+    return {"lines": lines, "seconds": elapsed, "mb_per_sec": os.path.getsize(path) / 2**20 / elapsed}
+
+def bench_parse(importer, path, timezone):
+    importer.apache2_minute_epoch.cache_clear()
+    importer.apache2_ipv6_packed.cache_clear()
+    with open(path) as file:
+        lines = sum(1 for _ in file)
+    rows = 0
+    started = time.perf_counter()
+    with open(path) as text, quiet():
+        for columns in importer.apache2_parse_log(text, timezone):
+            rows += len(columns[0])
+    elapsed = time.perf_counter() - started
+    return {"lines": lines, "rows": rows, "seconds": elapsed, "lines_per_sec": lines / elapsed}
+
+def bench_import(importer, client, path, workers):
+    importer.data_truncate(client)
+    started = time.perf_counter()
+    with quiet():
+        if workers > 1:
+            rows = importer.import_files_parallel([path], workers)
+        else:
+            rows = importer.import_file(client, path)
+    elapsed = time.perf_counter() - started
+    return {"rows": rows, "workers": workers, "seconds": elapsed, "rows_per_sec": rows / elapsed}
+
+def bench_export(app, url, rows):
+    size = 0
+    with app.test_client() as http, RssSampler() as rss:
+        started = time.perf_counter()
+        response = http.get(url, buffered=False)
+        for chunk in response.response:
+            size += len(chunk)
+        response.close()
+        elapsed = time.perf_counter() - started
+    return {
+        "bytes": size,
+        "seconds": elapsed,
+        "mb_per_sec": size / 2**20 / elapsed,
+        "rows_per_sec": rows / elapsed,
+        "peak_rss_mb": rss.peak / 2**20,
+        "peak_rss_growth_mb": (rss.peak - rss.baseline) / 2**20,
+    }
+
+def bench_latency(logger, app, urls, repeat):
+    results = {}
+    with app.test_client() as http:
+        for url in urls:
+            timings = []
+            # The first request also pays for imports and connections
+            http.get(url)
+            for _ in range(repeat):
+                # Every request is a cache miss
+                logger.response_cache.bump_generation()
+                started = time.perf_counter()
+                response = http.get(url)
+                timings.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url} answered {response.status_code}: {response.get_data(as_text=True)}")
+            timings.sort()
+            results[url] = {
+                "p50_ms": statistics.median(timings) * 1000,
+                "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+                "bytes": len(response.get_data()),
+            }
+    return results
+
+def graph_urls(logger, client):
+    (ip,), = client.execute("SELECT ip FROM apache_logs_ip_hourly GROUP BY ip ORDER BY sum(requests) DESC LIMIT 1")
+    (start, end), = client.execute("SELECT toUnixTimestamp(min(timestamp)), toUnixTimestamp(max(timestamp)) FROM apache_logs")
+    week = f"start_time={end - 7 * 86400}&end_time={end}"
+    urls = ['/api/db/get_date_range']
+    for query in ('', f'?{week}'):
+        for name in logger.graph_names:
+            urls.append(f'/api/graph_show/{name}{query}')
+        urls.append(f'/api/dashboard{query}')
+    urls += [f'/api/graph_show/{name}?format=json' for name in logger.graph_names]
+    urls.append('/api/dashboard?format=json')
+    urls.append(f'/api/details/ip/{ip}')
+    urls.append(f'/api/details/ip/{ip}?start_time={start}&end_time={end}&limit=1000')
+    return urls
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def run(args):
+    importer, logger, client = backend_chdb(args) if args.backend == 'chdb' else backend_clickhouse(args)
+    app = logger.create_app()
+    timezone = importer.db_timezone(client)
+    results = {
+        "meta": {
+            "started_at": datetime.datetime.now().isoformat(timespec='seconds'),
+            "git_commit": git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "backend": args.backend,
+            "log": os.path.abspath(args.log),
+            "log_bytes": os.path.getsize(args.log),
+            "repeat": args.repeat,
+        },
+    }
+    print("Startup...")
+    results["startup"] = bench_startup(min(args.repeat, 5))
+    print("Stream...")
+    results["stream"] = bench_stream(importer, args.log)
+    print("Parse...")
+    results["parse"] = bench_parse(importer, args.log, timezone)
+    print("Import...")
+    results["import"] = bench_import(importer, client, args.log, args.workers)
+    logger.response_cache.bump_generation()
+    print("Export...")
+    rows = results["import"]["rows"]
+    results["export_csv"] = bench_export(app, '/api/export/csv/0', rows)
+    results["export_parquet"] = bench_export(app, '/api/export/parquet/0', rows)
+    print("Graphs...")
+    results["latency"] = bench_latency(logger, app, graph_urls(logger, client), args.repeat)
+    if args.backend == 'clickhouse' and not args.keep:
+        client.execute(f"DROP DATABASE {BENCH_DATABASE}")
+    return results
+
+# metric: True if higher is better
+compare_metrics = {
+    'mb_per_sec': True,
+    'lines_per_sec': True,
+    'rows_per_sec': True,
+    'peak_rss_mb': False,
+    'peak_rss_growth_mb': False,
+    'p50_ms': False,
+    'p95_ms': False,
+}
+
+def compare_rows(before, after, prefix=''):
+    for key, value in after.items():
+        if key not in before:
+            continue
+        if isinstance(value, dict):
+            yield from compare_rows(before[key], value, f"{prefix}{key} ")
+        elif key in compare_metrics and before[key]:
+            ratio = value / before[key]
+            better = ratio > 1 if compare_metrics[key] else ratio < 1
+            yield f"{prefix}{key}", before[key], value, ratio, better
+
+def compare(args):
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+    before.pop('meta', None), after.pop('meta', None)
+    for metric, old, new, ratio, better in compare_rows(before, after):
+        mark = ' ' if abs(ratio - 1) <= args.threshold else '+' if better else '-'
+        print(f"{mark} {metric:<70} {old:>12.2f} {new:>12.2f} {ratio:>7.2f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the log parser, import, export and graph API.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help="write a synthetic Apache log")
+    generate.add_argument('output', help="log file to write")
+    generate.add_argument('--lines', type=int, default=1000000, help="number of lines (default: 1000000)")
+    generate.add_argument('--ips', type=int, default=10000, help="distinct client addresses (default: 10000)")
+    generate.add_argument('--paths', type=int, default=1000, help="distinct paths (default: 1000)")
+    generate.add_argument('--error-rate', type=float, default=0.05, help="share of 4xx/5xx responses (default: 0.05)")
+    generate.add_argument('--malformed-rate', type=float, default=0.001,
+                          help="share of lines the parser rejects (default: 0.001)")
+    generate.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date(2024, 1, 1),
+                          help="date of the first line (default: 2024-01-01)")
+    generate.add_argument('--days', type=int, default=30, help="days the log spans (default: 30)")
+    generate.add_argument('--seed', type=int, default=42, help="random seed (default: 42)")
+    run_parser = commands.add_parser('run', help="run the benchmarks on a log and save the results as JSON")
+    run_parser.add_argument('log', help="log file, e.g. from `generate`")
+    run_parser.add_argument('--backend', choices=('clickhouse', 'chdb'), default='clickhouse',
+                            help=f"the CHDB_* configured server (database {BENCH_DATABASE}) or in-process chdb")
+    run_parser.add_argument('--chdb-path', metavar='DIR', help="chdb data directory (default: temporary)")
+    run_parser.add_argument('-j', '--workers', type=int, default=1, help="import processes, clickhouse backend only")
+    run_parser.add_argument('--repeat', type=int, default=20, help="requests per graph endpoint (default: 20)")
+    run_parser.add_argument('--keep', action='store_true', help=f"keep the {BENCH_DATABASE} database afterwards")
+    run_parser.add_argument('-o', '--output', metavar='PATH', help="results file (default: print to stdout)")
+    compare_parser = commands.add_parser('compare', help="compare two results files")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.05,
+                                help="relative change to flag as a regression (default: 0.05)")
+    args = parser.parse_args()
+    if args.command == 'generate':
+        with open(args.output, 'w') as file:
+            generate_log(file, args.lines, args.ips, args.paths, args.error_rate, args.malformed_rate,
+                         datetime.datetime.combine(args.start, datetime.time()), args.days, args.seed)
+        exit(0)
+    if args.command == 'compare':
+        compare(args)
+        exit(0)
+    if args.backend == 'chdb' and args.workers > 1:
+        print("The chdb backend runs in this process, -j is only supported with --backend clickhouse.")
+        exit(1)
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(results + '\n')
+    else:
+        print(results)
@@ -0,0 +1,101 @@
+import json
+import plotly
+import plotly.express as px
+import plotly.graph_objects as go
+
+# Plotly figures of the chart data, for format=figure. Loaded by the web app on first use,
+# as plotly alone takes longer to import than the rest of the app.
+
+def create_empty_graph(message="Нет данных для отображения", font_color='#34495e'):
+    fig = go.Figure()
+    fig.add_annotation(
+        text=message,
+        xref="paper", yref="paper",
+        x=0.5, y=0.5,
+        showarrow=False,
+        font=dict(size=20, color=font_color),
+    )
+    fig.update_layout(
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        xaxis=dict(visible=False),
+        yaxis=dict(visible=False),
+        margin=dict(l=40, r=40, t=20, b=40),
+    )
+    return fig
+
+def graph1_figure(df):
+    if df.empty:
+        fig = create_empty_graph("Нет данных о запросах")
+    else:
+        fig = px.line(df, x='date', y='total_requests', title="График запросов", line_shape='linear')
+        fig.update_layout(xaxis_title="Дата", yaxis_title="Запросы", showlegend=False)
+    return fig
+
+def graph2_figure(df):
+    if df.empty:
+        fig = create_empty_graph("Нет данных об отказах")
+    else:
+        fig = px.line(df, x='date', y='total_failures', title="График отказов", line_shape='linear')
+        fig.update_layout(xaxis_title="Дата", yaxis_title="Отказы", showlegend=False)
+    return fig
+
+def graph3_figure(df):
+    if df.empty:
+        fig = create_empty_graph("Нет данных о топ-10 IP")
+    else:
+        fig = px.bar(df, x='ip', y='request_count', title="График топ-10 IP", text_auto=True)
+        fig.update_layout(xaxis_title="IP", yaxis_title="Запросы", showlegend=False)
+    return fig
+
+def graph4_figure(df):
+    if df.empty:
+        fig = create_empty_graph("Нет данных о кодах состояния")
+    else:
+        fig = px.pie(df, names='status_group', values='count', title="Распределение кодов состояния")
+        fig.update_traces(textinfo='percent+label')
+        fig.update_layout(showlegend=True)
+    return fig
+
+def graph5_figure(df):
+    if df.empty:
+        fig = create_empty_graph("Нет данных о времени ответа")
+    else:
+        fig = px.line(df, x='date', y='avg_response_time', title="Среднее время ответа", line_shape='linear')
+        fig.update_layout(xaxis_title="Дата", yaxis_title="Среднее время ответа (мс)", showlegend=False)
+    return fig
+
+def heatmap_figure(df):
+    if df.empty:
+        fig = create_empty_graph("Нет данных для тепловой карты")
+    else:
+        # Pivot: дни — строки, часы — столбцы; все 7 дней, даже если диапазон их не покрывает
+        df_pivot = df.pivot(index='day_of_week', columns='hour', values='request_count').fillna(0)
+        df_pivot = df_pivot.reindex(range(1, 8), fill_value=0)
+        # Переименуем дни недели в русские
+        days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+        fig = go.Figure(data=go.Heatmap(
+            z=df_pivot.values,
+            x=df_pivot.columns.astype(str),
+            y=days,
+            colorscale='YlGnBu'
+        ))
+        fig.update_layout(
+            title="Тепловая карта запросов по дням и часам",
+            xaxis_title="Час",
+            yaxis_title="День недели",
+            margin=dict(l=40, r=40, t=40, b=40),
+        )
+    return fig
+
+graph_figures = {
+    'graph1': graph1_figure,
+    'graph2': graph2_figure,
+    'graph3': graph3_figure,
+    'graph4': graph4_figure,
+    'graph5': graph5_figure,
+    'heatmap': heatmap_figure,
+}
+
+def figures_json(figures):
+    return json.dumps(figures, cls=plotly.utils.PlotlyJSONEncoder)
@@ -1,16 +1,21 @@
 CREATE DATABASE IF NOT EXISTS logger;
 CREATE TABLE IF NOT EXISTS logger.apache_logs (
-    ip String,
-    timestamp DateTime,
-    method String,
-    path String,
-    protocol String,
-    status UInt16,
-    bytes_sent UInt32,
-    referrer String,
-    user_agent String,
-    response_time UInt32
+    ip IPv6 CODEC(ZSTD(1)),
+    timestamp DateTime CODEC(DoubleDelta, ZSTD(1)),
+    method LowCardinality(String),
+    path String CODEC(ZSTD(3)),
+    protocol LowCardinality(String),
+    status UInt16 CODEC(ZSTD(1)),
+    bytes_sent UInt32 CODEC(T64, ZSTD(1)),
+    referrer String CODEC(ZSTD(3)),
+    user_agent LowCardinality(String) CODEC(ZSTD(1)),
+    response_time UInt32 CODEC(T64, ZSTD(1)),
+    PROJECTION ip_lookup (SELECT ip, timestamp, method, path, status, bytes_sent, response_time ORDER BY ip, timestamp)
 )
 ENGINE = MergeTree()
 PARTITION BY toYYYYMM(timestamp)
-ORDER BY (timestamp, ip);
\ No newline at end of file
+ORDER BY (timestamp, ip)
+-- Optional retention, drops whole parts older than 12 months:
+-- TTL timestamp + INTERVAL 12 MONTH DELETE
+-- The deduplication window lets --follow retry a flush without inserting its rows twice
+SETTINGS lightweight_mutation_projection_mode = 'rebuild', non_replicated_deduplication_window = 1000;
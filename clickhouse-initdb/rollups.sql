@@ -0,0 +1,35 @@
+CREATE TABLE IF NOT EXISTS logger.apache_logs_hourly (
+    hour DateTime,
+    status_class UInt8,
+    requests UInt64,
+    response_time_sum UInt64
+)
+ENGINE = SummingMergeTree()
+PARTITION BY toYYYYMM(hour)
+ORDER BY (hour, status_class);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS logger.apache_logs_hourly_mv TO logger.apache_logs_hourly AS
+SELECT
+    toStartOfHour(timestamp) AS hour,
+    intDiv(status, 100) AS status_class,
+    count() AS requests,
+    sum(response_time) AS response_time_sum
+FROM logger.apache_logs
+GROUP BY hour, status_class;
+
+CREATE TABLE IF NOT EXISTS logger.apache_logs_ip_hourly (
+    hour DateTime,
+    ip String,
+    requests UInt64
+)
+ENGINE = SummingMergeTree()
+PARTITION BY toYYYYMM(hour)
+ORDER BY (hour, ip);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS logger.apache_logs_ip_hourly_mv TO logger.apache_logs_ip_hourly AS
+SELECT
+    toStartOfHour(timestamp) AS hour,
+    replaceRegexpOne(toString(ip), '^::ffff:', '') AS ip,
+    count() AS requests
+FROM logger.apache_logs
+GROUP BY hour, ip;
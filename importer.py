@@ -0,0 +1,819 @@
+import argparse
+import bisect
+import bz2
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import glob
+import gzip
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import clickhouse_driver
+from clickhouse_driver import errors as clickhouse_errors
+import pytz
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Import side of the logger: parsing, inserting and maintaining apache_logs. Only needs the
+# ClickHouse driver, so the CLI starts without the web app's Flask, pandas, pyarrow and plotly.
+
+# Logging setup
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Config from ENV
+CHDB_HOST = os.getenv('CHDB_HOST', 'localhost')
+CHDB_PORT = os.getenv('CHDB_PORT', '9000')
+CHDB_DATABASE = os.getenv('CHDB_DATABASE', 'logger')
+CHDB_USER = os.getenv('CHDB_USER', 'test')
+CHDB_PASSWORD = os.getenv('CHDB_PASSWORD', 'test')
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 64 * 1024 * 1024))
+IMPORT_BLOCK_SIZE = int(os.getenv('IMPORT_BLOCK_SIZE', 200000))
+IMPORT_READ_SIZE = 1024 * 1024
+FOLLOW_BATCH_ROWS = int(os.getenv('FOLLOW_BATCH_ROWS', 10000))
+FOLLOW_BATCH_SECONDS = float(os.getenv('FOLLOW_BATCH_SECONDS', 5))
+FOLLOW_POLL_INTERVAL = 0.5
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+REJECTED_LINES_KEEP = 100
+
+class Metrics:
+    # Counters, histograms and callback gauges, served at /metrics in the Prometheus text format
+    def __init__(self):
+        self.families = {}  # name: (type, help, buckets, callback, label)
+        self.series = collections.defaultdict(dict)  # name: {labels: value or [bucket counts, sum]}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, callback=None):
+        # With a callback the value is read from it at render time, e.g. for stats kept elsewhere
+        self.families[name] = ('counter', help, None, callback, None)
+
+    def histogram(self, name, help, buckets=METRICS_BUCKETS):
+        self.families[name] = ('histogram', help, buckets, None, None)
+
+    def gauge(self, name, help, callback, label=None):
+        # With a label, callback returns {label value: value}
+        self.families[name] = ('gauge', help, None, callback, label)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.families[name][2]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.series[name].setdefault(key, [[0] * (len(buckets) + 1), 0])
+            counts[0][bisect.bisect_left(buckets, value)] += 1
+            counts[1] += value
+
+    @staticmethod
+    def labels(items):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}' if items else ''
+
+    def render(self):
+        with self.lock:
+            snapshot = {
+                name: {key: [list(value[0]), value[1]] if isinstance(value, list) else value for key, value in series.items()}
+                for name, series in self.series.items()
+            }
+        lines = []
+        for name, (kind, help, buckets, callback, label) in self.families.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            if callback:
+                if label:
+                    lines += [f"{name}{self.labels([(label, k)])} {v}" for k, v in callback().items()]
+                else:
+                    lines.append(f"{name} {callback()}")
+            elif kind == 'counter':
+                lines += [f"{name}{self.labels(key)} {value}" for key, value in snapshot.get(name, {}).items()]
+            else:
+                for key, (counts, total) in snapshot.get(name, {}).items():
+                    for le, cumulative in zip([*buckets, '+Inf'], itertools.accumulate(counts)):
+                        lines.append(f"{name}_bucket{self.labels([*key, ('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{self.labels(key)} {total}")
+                    lines.append(f"{name}_count{self.labels(key)} {sum(counts)}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('logger_clickhouse_query_duration_seconds', "ClickHouse query time over the native protocol.")
+metrics.counter('logger_clickhouse_query_errors_total', "ClickHouse queries that failed or were cancelled.")
+metrics.counter('logger_clickhouse_read_rows_total', "Rows read by ClickHouse queries (query progress).")
+metrics.counter('logger_clickhouse_read_bytes_total', "Uncompressed bytes read by ClickHouse queries (query progress).")
+metrics.counter('logger_clickhouse_result_rows_total', "Rows returned by ClickHouse queries (profile info).")
+metrics.counter('logger_import_lines_total', "Log lines parsed, by result: parsed or rejected.")
+metrics.counter('logger_import_rows_total', "Rows inserted into apache_logs.")
+
+# The latest lines that did not match apache2_regex, for /api/import/rejected
+rejected_lines = collections.deque(maxlen=REJECTED_LINES_KEEP)
+
+def db_client(client_name, settings=None):
+    return clickhouse_driver.Client(
+        host=CHDB_HOST,
+        port=CHDB_PORT,
+        database=CHDB_DATABASE,
+        user=CHDB_USER,
+        password=CHDB_PASSWORD,
+        client_name=client_name,
+        settings={'use_numpy': False, 'insert_block_size': IMPORT_BLOCK_SIZE, **(settings or {})}
+    )
+
+@contextlib.contextmanager
+def db_query_metrics(client, kind):
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        metrics.inc('logger_clickhouse_query_errors_total', kind=kind)
+        raise
+    metrics.observe('logger_clickhouse_query_duration_seconds', time.perf_counter() - started, kind=kind)
+    if client.last_query:
+        metrics.inc('logger_clickhouse_read_rows_total', client.last_query.progress.rows, kind=kind)
+        metrics.inc('logger_clickhouse_read_bytes_total', client.last_query.progress.bytes, kind=kind)
+        metrics.inc('logger_clickhouse_result_rows_total', client.last_query.profile_info.rows, kind=kind)
+
+def db_timezone(client):
+    # Offset-naive datetimes are stored in the server timezone
+    client.connection.force_connect()
+    return pytz.timezone(client.connection.server_info.get_timezone())
+
+def db_insert_keep_duplicates(client):
+    # Insert settings bypassing the apache_logs deduplication window, which is meant for --follow
+    # retries only: a file imported twice is inserted twice. Newer servers replaced
+    # insert_deduplicate by deduplicate_insert and ignore the former.
+    (renamed,), = client.execute("SELECT count() FROM system.settings WHERE name = 'deduplicate_insert'")
+    return {'deduplicate_insert': 'disable'} if renamed else {'insert_deduplicate': 0}
+
+apache2_regex = re.compile(
+    r'^(?P<ip>\S+)\s-\s-\s\[(?P<timestamp>[^\]]+)\]\s'
+    r'"(?P<method>\S+)\s(?P<path>\S+)\s(?P<protocol>[^"]+)"\s'
+    r'(?P<status>\d+)\s'
+    r'(?P<bytes_sent>\d+)\s'
+    r'"(?P<referrer>[^"]*)"\s'
+    r'"(?P<user_agent>[^"]*)"\s'
+    r'(?P<response_time>\d+)$'
+)
+
+def apache2_parse_timestamp(dt_string, timezone):
+    # Only the "YYYY-MM-DD HH:MM" prefix goes through strptime and the timezone, the seconds are added to it
+    minute, _, seconds = dt_string.replace("+0300", "").strip().rpartition(':')
+    return apache2_minute_epoch(minute, timezone) + int(seconds)
+
+@functools.lru_cache(maxsize=65536)
+def apache2_minute_epoch(minute, timezone):
+    dt = datetime.datetime.strptime(minute, "%Y-%m-%d %H:%M")
+    return int(timezone.localize(dt).timestamp())
+
+@functools.lru_cache(65536)
+def apache2_ipv6_packed(ip):
+    # IPv4 is stored IPv4-mapped (::ffff:a.b.c.d), as ClickHouse casts it from String.
+    # None for a host name (HostnameLookups On): there is no address to store.
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if address.version == 4:
+        return b'\0' * 10 + b'\xff\xff' + address.packed
+    return address.packed
+
+def apache2_parse_block(lines, timezone):
+    rejected = []
+    def matched():
+        for line in lines:
+            # Lines without an IP address are rejected too, the ip column can't store them
+            if (match := apache2_regex.match(line)) and apache2_ipv6_packed(match.group(1)) is not None:
+                yield match.groups()
+            else:
+                rejected.append(line)
+    rows = list(matched())
+    metrics.inc('logger_import_lines_total', len(rows), result='parsed')
+    if rejected:
+        metrics.inc('logger_import_lines_total', len(rejected), result='rejected')
+        rejected_lines.extend(line.rstrip('\n') for line in rejected[-REJECTED_LINES_KEEP:])
+        logger.warning(f"{len(rejected)} of {len(lines)} lines don't match the log format or have no IP address, e.g. {rejected[0].rstrip()!r}")
+    if not rows:
+        return None
+    ip, timestamp, method, path, protocol, status, bytes_sent, referrer, user_agent, response_time = zip(*rows)
+    return [
+        ip,
+        list(map(apache2_parse_timestamp, timestamp, itertools.repeat(timezone))),
+        method,
+        path,
+        protocol,
+        list(map(int, status)),
+        [int(i) if i.isdigit() else 0 for i in bytes_sent],
+        referrer,
+        user_agent,
+        list(map(int, response_time)),
+    ]
+
+def apache2_parse_log(text: io.TextIOWrapper, timezone, block_size=IMPORT_BLOCK_SIZE, stats=None):
+    # Yields blocks of lines as per-column lists, in apache_logs column order
+    line_i = 0
+    while lines := list(itertools.islice(text, block_size)):
+        if (line_i + len(lines)) // 100000 > line_i // 100000:
+            print(f"Checkpoint: line {line_i + len(lines)}...")
+        line_i += len(lines)
+        columns = apache2_parse_block(lines, timezone)
+        parsed = len(columns[0]) if columns else 0
+        if stats:
+            stats.lines_parsed += parsed
+            stats.lines_rejected += len(lines) - parsed
+        if columns:
+            yield columns
+
+def insert_apache_columns(client, columns, settings=None):
+    # Tables from before --migrate-schema keep ip as String, the current schema has IPv6.
+    # The type is checked per block, so imports keep working across a migration.
+    for attempt in range(2):
+        (ip_type,), = client.execute(
+            "SELECT type FROM system.columns WHERE database = currentDatabase() AND table = 'apache_logs' AND name = 'ip'"
+        )
+        if ip_type == 'IPv6':
+            columns = [list(map(apache2_ipv6_packed, columns[0])), *columns[1:]]
+        try:
+            with db_query_metrics(client, 'insert'):
+                rows = client.execute('INSERT INTO apache_logs VALUES', columns, columnar=True, settings=settings)
+            metrics.inc('logger_import_rows_total', rows)
+            return rows
+        except clickhouse_errors.CannotParseDomainError:
+            # The migration swapped the tables between the check and the insert
+            if attempt:
+                raise
+
+def insert_apache_log(client, text: io.TextIOWrapper, stats=None):
+    timezone = db_timezone(client)
+    settings = db_insert_keep_duplicates(client)
+    rows = 0
+    for columns in apache2_parse_log(text, timezone, stats=stats):
+        rows += insert_apache_columns(client, columns, settings=settings)
+        if stats:
+            stats.rows_inserted = rows
+    return rows
+
+def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
+    class IterStream(io.RawIOBase):
+        def __init__(self):
+            self.leftover = None
+        def readable(self):
+            return True
+        def readinto(self, b):
+            try:
+                l = len(b)
+                chunk = self.leftover or next(iterable)
+                output, self.leftover = chunk[:l], chunk[l:]
+                b[:len(output)] = output
+                return len(output)
+            except StopIteration:
+                return 0
+    return io.BufferedReader(IterStream(), buffer_size=buffer_size)
+
+def get_db_size(client):
+    count = client.execute("SELECT count() FROM apache_logs")[0][0]
+    size_human, size = client.execute("SELECT formatReadableSize(sum(bytes)), sum(bytes) FROM system.parts WHERE active AND table = 'apache_logs'")[0]
+    return count, size, size_human
+
+# ip as text: IPv4 addresses are stored IPv4-mapped in the IPv6 column. Also a no-op on
+# the String column of tables not migrated yet.
+ip_text_sql = "replaceRegexpOne(toString(ip), '^::ffff:', '')"
+
+# Hourly rollups, kept up to date by materialized views (clickhouse-initdb/rollups.sql)
+rollup_sources = {
+    'apache_logs_hourly': (
+        "SELECT toStartOfHour(timestamp) AS hour, intDiv(status, 100) AS status_class,"
+        " count() AS requests, sum(response_time) AS response_time_sum"
+        " FROM apache_logs WHERE {where} GROUP BY hour, status_class"
+    ),
+    'apache_logs_ip_hourly': (
+        f"SELECT toStartOfHour(timestamp) AS hour, {ip_text_sql} AS ip, count() AS requests"
+        " FROM apache_logs WHERE {where} GROUP BY hour, ip"
+    ),
+}
+
+def rollups_rebuild(client):
+    # Run while no imports are in progress, or rows inserted meanwhile may be counted twice
+    partitions = [p for (p,) in client.execute(
+        "SELECT DISTINCT partition FROM system.parts"
+        " WHERE active AND database = currentDatabase() AND table = 'apache_logs' ORDER BY partition"
+    )]
+    for table, select in rollup_sources.items():
+        client.execute(f"TRUNCATE TABLE {table}")
+        for partition in partitions:
+            logger.info(f"Rebuilding {table} for partition {partition}...")
+            client.execute(f"INSERT INTO {table} " + select.format(where=f"toYYYYMM(timestamp) = {int(partition)}"))
+
+# Data lifecycle: apache_logs and the rollups are all partitioned by toYYYYMM, so whole months
+# are dropped instantly and only the uneven edges of a range need a DELETE mutation
+def partitions_list(client):
+    return client.execute(
+        "SELECT partition_id, toUnixTimestamp(min(min_time)), toUnixTimestamp(max(max_time)), sum(rows), sum(bytes_on_disk)"
+        " FROM system.parts"
+        " WHERE active AND database = currentDatabase() AND table = 'apache_logs'"
+        " GROUP BY partition_id ORDER BY partition_id"
+    )
+
+def partitions_drop(client, partition_ids):
+    for partition_id in partition_ids:
+        logger.info(f"Dropping partition {partition_id}...")
+        for table in ('apache_logs', *rollup_sources):
+            client.execute(f"ALTER TABLE {table} DROP PARTITION ID '{partition_id}'")
+
+def data_truncate(client):
+    for table in ('apache_logs', *rollup_sources):
+        client.execute(f"TRUNCATE TABLE IF EXISTS {table}")
+
+def data_delete_range(client, start_time, end_time):
+    # Deletes rows with start_time <= timestamp <= end_time (unix seconds).
+    # Returns (dropped partition ids, rows deleted by mutation).
+    params = {'start_time': int(start_time), 'end_time': int(end_time)}
+    # Months lying completely inside the range, by the server's calendar
+    covered = [partition_id for (partition_id,) in client.execute(
+        "SELECT partition_id FROM system.parts"
+        " WHERE active AND database = currentDatabase() AND table = 'apache_logs'"
+        " GROUP BY partition_id HAVING"
+        " toDateTime(toStartOfMonth(min(min_time))) >= toDateTime(%(start_time)s)"
+        " AND toDateTime(addMonths(toStartOfMonth(min(min_time)), 1)) <= toDateTime(%(end_time)s) + 1",
+        params
+    )]
+    partitions_drop(client, covered)
+    where = "timestamp BETWEEN toDateTime(%(start_time)s) AND toDateTime(%(end_time)s)"
+    (rows,), = client.execute(f"SELECT count() FROM apache_logs WHERE {where}", params)
+    if rows:
+        client.execute(f"DELETE FROM apache_logs WHERE {where}", params)
+        # Rollup hours inside the range go away, the two edge hours are recounted from what is left
+        edges = (
+            "(timestamp >= toStartOfHour(toDateTime(%(start_time)s)) AND timestamp < toStartOfHour(toDateTime(%(start_time)s)) + 3600)"
+            " OR (timestamp >= toStartOfHour(toDateTime(%(end_time)s)) AND timestamp < toStartOfHour(toDateTime(%(end_time)s)) + 3600)"
+        )
+        for table, select in rollup_sources.items():
+            client.execute(
+                f"DELETE FROM {table} WHERE hour BETWEEN toStartOfHour(toDateTime(%(start_time)s))"
+                " AND toStartOfHour(toDateTime(%(end_time)s))", params
+            )
+            client.execute(f"INSERT INTO {table} " + select.format(where=edges), params)
+    return covered, rows
+
+def retention_apply(client, months):
+    # Drops the months whose data is all older than `months` months
+    expired = [partition_id for (partition_id,) in client.execute(
+        "SELECT DISTINCT partition_id FROM system.parts"
+        " WHERE active AND database = currentDatabase() AND table = 'apache_logs'"
+        " AND toUInt32(partition_id) < toYYYYMM(subtractMonths(now(), %(months)s))",
+        {'months': int(months)}
+    )]
+    partitions_drop(client, expired)
+    return expired
+
+# Copy of apache_logs sorted by ip for /api/details/ip, see clickhouse-initdb/logs.sql
+ip_projection_sql = "SELECT ip, timestamp, method, path, status, bytes_sent, response_time ORDER BY ip, timestamp"
+
+def ip_projection_add(client):
+    # Tables created before the projection existed: add it and build it for the existing parts.
+    # Lightweight deletes (/api/db/clean) refuse to run on tables with projections unless told to rebuild them.
+    client.execute("ALTER TABLE apache_logs MODIFY SETTING lightweight_mutation_projection_mode = 'rebuild'")
+    client.execute(f"ALTER TABLE apache_logs ADD PROJECTION IF NOT EXISTS ip_lookup ({ip_projection_sql})")
+    client.execute("ALTER TABLE apache_logs MATERIALIZE PROJECTION ip_lookup", settings={'mutations_sync': 1})
+
+# Current apache_logs schema, same as clickhouse-initdb/logs.sql
+apache_logs_schema = """CREATE TABLE {table} (
+    ip IPv6 CODEC(ZSTD(1)),
+    timestamp DateTime CODEC(DoubleDelta, ZSTD(1)),
+    method LowCardinality(String),
+    path String CODEC(ZSTD(3)),
+    protocol LowCardinality(String),
+    status UInt16 CODEC(ZSTD(1)),
+    bytes_sent UInt32 CODEC(T64, ZSTD(1)),
+    referrer String CODEC(ZSTD(3)),
+    user_agent LowCardinality(String) CODEC(ZSTD(1)),
+    response_time UInt32 CODEC(T64, ZSTD(1)),
+    PROJECTION ip_lookup ({ip_projection})
+)
+ENGINE = MergeTree()
+PARTITION BY toYYYYMM(timestamp)
+ORDER BY (timestamp, ip)
+{ttl}SETTINGS lightweight_mutation_projection_mode = 'rebuild', non_replicated_deduplication_window = 1000{settings}"""
+
+schema_migrate_select = (
+    "SELECT toIPv6OrDefault(toString(ip)), timestamp, method, path, protocol,"
+    " status, bytes_sent, referrer, user_agent, response_time FROM {source}"
+    " WHERE _partition_id = %(partition_id)s AND _part IN %(parts)s"
+)
+
+def schema_migrate_unmappable(client):
+    # Rows whose ip the IPv6 column can't hold (host names): the copy would turn them into ::
+    return client.execute("SELECT count() FROM apache_logs WHERE toIPv6OrNull(toString(ip)) IS NULL")[0][0]
+
+schema_migrate_unmappable_error = (
+    "{rows} rows of apache_logs have a host name instead of an IP address, the compact schema can't store them."
+    " Delete them first, e.g. ALTER TABLE apache_logs DELETE WHERE toIPv6OrNull(toString(ip)) IS NULL."
+)
+
+def schema_migrate_copy(client, source, target, copied):
+    # Copies the parts of source not copied yet, a partition at a time; returns the rows copied
+    parts = {}
+    for partition_id, name, rows in client.execute(
+        "SELECT partition_id, name, rows FROM system.parts"
+        " WHERE active AND database = currentDatabase() AND table = %(table)s ORDER BY partition_id, name",
+        {'table': source}
+    ):
+        if name not in copied:
+            parts.setdefault(partition_id, []).append((name, rows))
+    settings = db_insert_keep_duplicates(client)
+    total = 0
+    for partition_id, partition_parts in parts.items():
+        names = tuple(name for name, _ in partition_parts)
+        rows = sum(rows for _, rows in partition_parts)
+        logger.info(f"Migrating partition {partition_id}: {len(names)} parts, {rows} rows...")
+        client.execute(f"INSERT INTO {target} " + schema_migrate_select.format(source=source),
+                       {'partition_id': partition_id, 'parts': names}, settings=settings)
+        copied.update(names)
+        total += rows
+    return total
+
+def schema_migrate(client, ttl_months=None):
+    # Online copy of apache_logs into the current schema. Merges of the old table are stopped,
+    # so its parts keep their names and every part is copied exactly once, including the
+    # ones imported meanwhile. Returns get_db_size() before and after.
+    (ip_type,), = client.execute(
+        "SELECT type FROM system.columns WHERE database = currentDatabase() AND table = 'apache_logs' AND name = 'ip'"
+    )
+    if ip_type == 'IPv6':
+        raise RuntimeError("apache_logs already has the current schema.")
+    if client.execute("EXISTS TABLE apache_logs_migrate")[0][0]:
+        raise RuntimeError("Table apache_logs_migrate exists: an earlier migration was interrupted, check it and drop it first.")
+    if unmappable := schema_migrate_unmappable(client):
+        raise RuntimeError(schema_migrate_unmappable_error.format(rows=unmappable))
+    before = get_db_size(client)
+    ddl_args = {
+        'ip_projection': ip_projection_sql,
+        'ttl': f"TTL timestamp + INTERVAL {int(ttl_months)} MONTH DELETE\n" if ttl_months else "",
+        'settings': ", ttl_only_drop_parts = 1" if ttl_months else "",
+    }
+    client.execute(apache_logs_schema.format(table='apache_logs_migrate', **ddl_args))
+    client.execute(apache_logs_schema.format(table='apache_logs_migrate_tail', **ddl_args))
+    if client.execute("EXISTS TABLE apache_logs_ip_hourly_mv")[0][0]:
+        # Keeps writing text addresses into the rollup once the source ip is IPv6
+        client.execute(
+            "ALTER TABLE apache_logs_ip_hourly_mv MODIFY QUERY "
+            + rollup_sources['apache_logs_ip_hourly'].format(where="1")
+        )
+    client.execute("SYSTEM STOP MERGES apache_logs")
+    copied = set()
+    try:
+        # Repeat while imports keep adding a lot
+        while schema_migrate_copy(client, 'apache_logs', 'apache_logs_migrate', copied) > IMPORT_BLOCK_SIZE:
+            pass
+        # Imports by older versions may have added host names meanwhile
+        if unmappable := schema_migrate_unmappable(client):
+            client.execute("DROP TABLE apache_logs_migrate")
+            client.execute("DROP TABLE apache_logs_migrate_tail")
+            raise RuntimeError(schema_migrate_unmappable_error.format(rows=unmappable))
+        client.execute("EXCHANGE TABLES apache_logs AND apache_logs_migrate")
+        exchanged_at = time.monotonic()
+        # Inserts started before the exchange still write into the old table
+        while client.execute(
+            "SELECT count() FROM system.processes"
+            " WHERE query_kind = 'Insert' AND query LIKE 'INSERT INTO apache_logs %%' AND elapsed >= %(age)s",
+            {'age': time.monotonic() - exchanged_at}
+        )[0][0]:
+            time.sleep(1)
+        # Copying the rest straight into apache_logs would feed the rollup views a second time,
+        # attached partitions don't trigger them
+        if schema_migrate_copy(client, 'apache_logs_migrate', 'apache_logs_migrate_tail', copied):
+            for (partition_id,) in client.execute(
+                "SELECT DISTINCT partition_id FROM system.parts"
+                " WHERE active AND database = currentDatabase() AND table = 'apache_logs_migrate_tail'"
+            ):
+                client.execute(f"ALTER TABLE apache_logs ATTACH PARTITION ID '{partition_id}' FROM apache_logs_migrate_tail")
+    finally:
+        client.execute("SYSTEM START MERGES apache_logs")
+        # After the exchange it is the old table, with merges stopped
+        if client.execute("EXISTS TABLE apache_logs_migrate")[0][0]:
+            client.execute("SYSTEM START MERGES apache_logs_migrate")
+    client.execute("DROP TABLE apache_logs_migrate_tail")
+    client.execute("RENAME TABLE apache_logs_migrate TO apache_logs_old")
+    return before, get_db_size(client)
+
+def print_db_size(client):
+    count, _, size_human = get_db_size(client)
+    logger.info(f"Current db status: {count} lines, {size_human} size.")
+
+compression_magic = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bzip2',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+}
+
+content_encodings = {
+    'gzip': 'gzip',
+    'x-gzip': 'gzip',
+    'bzip2': 'bzip2',
+    'x-bzip2': 'bzip2',
+    'zstd': 'zstd',
+}
+
+def detect_compression(file: io.BufferedReader):
+    head = file.peek(4)[:4]
+    return next((name for magic, name in compression_magic.items() if head.startswith(magic)), None)
+
+def open_decompressed(file: io.BufferedReader, compression=None):
+    # Returns a binary stream decompressing `file` on the fly
+    compression = compression or detect_compression(file)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=file)
+    if compression == 'bzip2':
+        return bz2.BZ2File(file)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Package zstandard is required to import zstd compressed logs.")
+        reader = zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True)
+        return io.BufferedReader(reader, buffer_size=IMPORT_READ_SIZE)
+    return file
+
+def expand_import_files(patterns):
+    files = []
+    for pattern in patterns:
+        files += sorted(glob.glob(pattern)) or [pattern]
+    return list(dict.fromkeys(files))
+
+def import_file(client, path):
+    with open(path, 'rb') as file, open_decompressed(file) as stream:
+        return insert_apache_log(client, io.TextIOWrapper(stream))
+
+def file_split_ranges(path, chunk_size):
+    # Byte ranges of ~chunk_size, each one ending right after a newline (or at EOF)
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as file:
+        start = 0
+        while start < size:
+            file.seek(start + chunk_size)
+            file.readline()
+            end = min(file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def import_worker_init():
+    global import_client
+    import_client = db_client('logger-import-worker')
+
+def import_file_range(import_file, start, end):
+    with open(import_file, 'rb') as file:
+        file.seek(start)
+        text = io.TextIOWrapper(io.BytesIO(file.read(end - start)))
+    return insert_apache_log(import_client, text)
+
+def import_file_whole(path):
+    return import_file(import_client, path)
+
+def import_files_parallel(import_files, workers):
+    # Plain files are split into byte ranges, compressed ones can only be read as a whole
+    rows_total = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=import_worker_init) as executor:
+        futures = []
+        for path in import_files:
+            with open(path, 'rb') as file:
+                compression = detect_compression(file)
+            if compression:
+                futures.append(executor.submit(import_file_whole, path))
+            else:
+                futures += [executor.submit(import_file_range, path, start, end)
+                            for start, end in file_split_ranges(path, IMPORT_CHUNK_SIZE)]
+        for i, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            rows_total += future.result()
+            print(f"Checkpoint: chunk {i}/{len(futures)}, {rows_total} rows...")
+    return rows_total
+
+class ApacheLogFollower:
+    # `tail -F` for an Apache log: survives rotation and truncation, and keeps
+    # the byte offset of the last inserted line in a checkpoint file.
+    def __init__(self, client, path, checkpoint_path):
+        self.client = client
+        self.timezone = db_timezone(client)
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.file = None
+        self.inode = None
+        self.offset = 0  # end of the last line handed to `lines`
+        self.flushed_offset = 0
+        self.flush_end = None  # end of a batch whose insert may not have finished in the last run
+        self.pending = b''
+        self.lines = []
+        self.flushed_at = time.monotonic()
+        self.rows_inserted = 0
+
+    def checkpoint_load(self):
+        try:
+            with open(self.checkpoint_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def checkpoint_save(self, flushing=None):
+        checkpoint = {"path": self.path, "inode": self.inode, "offset": self.flushed_offset}
+        if flushing is not None:
+            checkpoint['flushing'] = flushing
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def open(self, checkpoint):
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(self.file.fileno())
+        self.inode = stat.st_ino
+        self.offset = 0
+        self.flush_end = None
+        if checkpoint.get('inode') == self.inode and checkpoint.get('offset', 0) <= stat.st_size:
+            self.offset = checkpoint['offset']
+            if checkpoint.get('flushing', 0) > self.offset and checkpoint['flushing'] <= stat.st_size:
+                self.flush_end = checkpoint['flushing']
+        self.flushed_offset = self.offset
+        self.pending = b''
+        self.file.seek(self.offset)
+        logger.info(f"Following {self.path} (inode {self.inode}) from offset {self.offset}...")
+        return True
+
+    def read(self):
+        size = IMPORT_READ_SIZE
+        if self.flush_end is not None:
+            # Not past the unfinished batch, so it is flushed again with the same range and token
+            size = min(size, self.flush_end - self.offset - len(self.pending))
+        chunk = self.file.read(size)
+        if not chunk:
+            return False
+        data = self.pending + chunk
+        complete = data.rfind(b'\n') + 1
+        self.pending = data[complete:]
+        if complete:
+            self.lines += io.TextIOWrapper(io.BytesIO(data[:complete]))
+            self.offset += complete
+        return True
+
+    def flush(self):
+        if self.flush_end is not None and self.offset != self.flush_end:
+            return
+        self.flush_end = None
+        if self.lines:
+            columns = apache2_parse_block(self.lines, self.timezone)
+            if columns:
+                # Saved before the insert: after a crash the same range is inserted again with
+                # the same token, which ClickHouse drops if the first insert got through
+                self.checkpoint_save(flushing=self.offset)
+                token = f"{self.inode}:{self.flushed_offset}-{self.offset}"
+                self.rows_inserted += insert_apache_columns(
+                    self.client, columns, settings={'insert_deduplication_token': token}
+                )
+            logger.info(f"Follow: {len(self.lines)} lines flushed, {self.rows_inserted} rows inserted in total.")
+            self.lines = []
+        if self.flushed_offset != self.offset:
+            self.flushed_offset = self.offset
+            self.checkpoint_save()
+        self.flushed_at = time.monotonic()
+
+    def rotated(self):
+        # The path now points to another file, or the file was truncated in place
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return stat.st_ino != self.inode or stat.st_size < self.offset + len(self.pending)
+
+    def run(self):
+        checkpoint = self.checkpoint_load()
+        try:
+            while True:
+                if self.file is None and not self.open(checkpoint):
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+                    continue
+                got_data = self.read()
+                if self.offset == self.flush_end or len(self.lines) >= FOLLOW_BATCH_ROWS or \
+                        (self.lines and time.monotonic() - self.flushed_at >= FOLLOW_BATCH_SECONDS):
+                    self.flush()
+                if got_data:
+                    continue
+                if self.rotated():
+                    # Old file is drained, a trailing line without newline is final
+                    if self.pending:
+                        self.lines += io.TextIOWrapper(io.BytesIO(self.pending))
+                        self.offset += len(self.pending)
+                    self.flush()
+                    self.file.close()
+                    self.file = None
+                    checkpoint = {}
+                    continue
+                time.sleep(FOLLOW_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            self.flush()
+        finally:
+            if self.file:
+                self.file.close()
+        return self.rows_inserted
+
+def main():
+    parser = argparse.ArgumentParser(description="Import Apache2 log files into ClickHouse.")
+    parser.add_argument('files', nargs='*', metavar='file',
+                        help="log files or glob patterns to import, plain or gzip/bzip2/zstd compressed")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="parse and insert the files in N processes (default: 1)")
+    parser.add_argument('-f', '--follow', action='store_true',
+                        help="keep importing lines appended to the file, like `tail -F`")
+    parser.add_argument('--checkpoint', metavar='PATH',
+                        help="offset checkpoint file for --follow (default: <file>.checkpoint)")
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help="refill the hourly rollup tables from apache_logs and exit")
+    parser.add_argument('--add-ip-projection', action='store_true',
+                        help="add the ip_lookup projection to an existing apache_logs table and exit")
+    parser.add_argument('--retention-months', type=int, metavar='N',
+                        help="drop the monthly partitions older than N months and exit (for cron)")
+    parser.add_argument('--migrate-schema', action='store_true',
+                        help="copy apache_logs into the current compact schema while it stays in use, and exit")
+    parser.add_argument('--ttl-months', type=int, metavar='N',
+                        help="with --migrate-schema: drop data older than N months (TTL)")
+    args = parser.parse_args()
+    if args.retention_months:
+        client = db_client('logger-retention')
+        dropped = retention_apply(client, args.retention_months)
+        print(f"Retention: {len(dropped)} partitions dropped {dropped}.")
+        print_db_size(client)
+        exit(0)
+    if args.migrate_schema:
+        logger.info(f"Schema migration started on {datetime.datetime.now()}...")
+        try:
+            before, after = schema_migrate(db_client('logger-migrate', {'max_execution_time': 0}), args.ttl_months)
+        except RuntimeError as e:
+            print(e)
+            exit(1)
+        print(f"Schema migration completed on {datetime.datetime.now()}.")
+        print(f"Before: {before[0]} lines, {before[2]} size.")
+        print(f"After: {after[0]} lines, {after[2]} size ({after[1] / max(before[1], 1):.0%}).")
+        print("The old table is kept as apache_logs_old, drop it once the data is checked.")
+        exit(0)
+    if args.add_ip_projection:
+        logger.info(f"Adding ip projection started on {datetime.datetime.now()}...")
+        ip_projection_add(db_client('logger-migrate', {'max_execution_time': 0}))
+        print(f"Adding ip projection completed on {datetime.datetime.now()}.")
+        exit(0)
+    if args.rebuild_rollups:
+        logger.info(f"Rollups rebuild started on {datetime.datetime.now()}...")
+        rollups_rebuild(db_client('logger-rollups'))
+        print(f"Rollups rebuild completed on {datetime.datetime.now()}.")
+        exit(0)
+    if not args.files:
+        print("Please provide a file to import.")
+        exit(1)
+    if args.follow:
+        if len(args.files) != 1:
+            print("Follow mode takes exactly one file.")
+            exit(1)
+        client = db_client('logger-follow')
+        print_db_size(client)
+        logger.info(f"Follow (local) started on {datetime.datetime.now()}...")
+        follower = ApacheLogFollower(client, args.files[0], args.checkpoint or args.files[0] + '.checkpoint')
+        follower.run()
+        print(f"Follow (local) stopped on {datetime.datetime.now()}.")
+        print_db_size(client)
+        exit(0)
+    import_files = expand_import_files(args.files)
+    for path in import_files:
+        if not os.path.isfile(path):
+            print(f"File {path} is not a file.")
+            exit(2)
+    if args.workers < 1:
+        print("Number of workers must be at least one.")
+        exit(1)
+    client = db_client('logger-import')
+    print_db_size(client)
+    logger.info(f"Import (local) started on {datetime.datetime.now()}...")
+    if args.workers > 1:
+        import_files_parallel(import_files, args.workers)
+    else:
+        for path in import_files:
+            logger.info(f"Importing {path}...")
+            import_file(client, path)
+    print(f"Import (local) completed on {datetime.datetime.now()}.")
+    print_db_size(client)
+    print("To start web-server, please use WGSI. For example, running dev-server: `python -m flask --app logger run`.")
+    exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -1,490 +1,1007 @@
-import itertools
-import os
-import sys
-import time
-from flask import Flask, request, Response, send_file
-import tempfile
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import functools
+import hashlib
 import io
-import clickhouse_driver
-import re
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-import plotly
-import plotly.express as px
-import plotly.graph_objects as go
+import ipaddress
 import json
-import datetime
 import logging
+import os
+import queue
+import re
+import select
 import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from flask import Blueprint, Flask, copy_current_request_context, current_app, g, has_request_context, request, Response
+from clickhouse_driver import errors as clickhouse_errors
+from importer import (
+    CHDB_DATABASE, CHDB_HOST, CHDB_PASSWORD, CHDB_USER, IMPORT_READ_SIZE, content_encodings, data_delete_range,
+    data_truncate, db_client, db_query_metrics, get_db_size, insert_apache_log, ip_text_sql, iterable_to_stream,
+    metrics, open_decompressed, partitions_list, rejected_lines, retention_apply,
+)
 
-tmp_files = []
+# Web app: create_app() is found by `flask --app logger`. pandas, numpy, pyarrow and plotly are
+# imported where they are first needed, so workers start fast; the CLI importer is importer.py.
 
 # Logging setup
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# For parquet export
-parquet_logs_schema = pa.schema([
-    ('ip', pa.string()),
-    ('timestamp', pa.date32()),
-    ('method', pa.string()),
-    ('path', pa.string()),
-    ('protocol', pa.string()),
-    ('status', pa.int32()),
-    ('bytes_sent', pa.int32()),
-    ('referrer', pa.string()),
-    ('user_agent', pa.string()),
-    ('response_time', pa.int32()),
-])
-
-def batched_it(iterable, n):
-    if n < 1:
-        raise ValueError('n must be at least one')
-    it = iter(iterable)
-    while True:
-        chunk_it = itertools.islice(it, n)
-        try:
-            first_el = next(chunk_it)
-        except StopIteration:
-            return
-        yield itertools.chain((first_el,), chunk_it)
-
-def parquet_get_batches(rows_iterable, chunk_size, schema):
-    for it in batched_it(rows_iterable, chunk_size):
-        pad = pd.DataFrame(it, columns=schema.names)
-        yield pa.RecordBatch.from_pandas(pad, schema=schema, preserve_index=False)
-
-def default_lines_stream_limit():
-    usage_info = shutil.disk_usage(tempfile.gettempdir())
-    available_disk = usage_info.free - 1024 * 1024
-    logger.info("Env LINES_STREAM_LIMIT is not set. Setting default one.")
-    if available_disk <= 0:
-        logger.warning("Available system RAM is too small. Setting LINES_STREAM_LIMIT=1000.")
-        return 1000
-    else:
-        rows_limit = available_disk // 20
-        logger.info(f"Setting LINES_STREAM_LIMIT={rows_limit}")
-        return rows_limit
+# For parquet export, integer types as in apache_logs
+@functools.cache
+def parquet_logs_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('ip', pa.string()),
+        ('timestamp', pa.timestamp('s', tz='UTC')),
+        ('method', pa.string()),
+        ('path', pa.string()),
+        ('protocol', pa.string()),
+        ('status', pa.uint16()),
+        ('bytes_sent', pa.uint32()),
+        ('referrer', pa.string()),
+        ('user_agent', pa.string()),
+        ('response_time', pa.uint32()),
+    ])
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file collecting written bytes until they are drained
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def parquet_write_batches(batches, schema, row_group_size):
+    # Yields parquet file bytes as soon as each row group is written
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sink = ChunkSink()
+    with pq.ParquetWriter(sink, schema=schema, compression='zstd') as writer:
+        group, group_rows = [], 0
+        for batch in batches:
+            group.append(batch)
+            group_rows += batch.num_rows
+            if group_rows >= row_group_size:
+                writer.write_table(pa.Table.from_batches(group).cast(schema), row_group_size=group_rows)
+                group, group_rows = [], 0
+                yield sink.drain()
+        if group:
+            writer.write_table(pa.Table.from_batches(group).cast(schema), row_group_size=group_rows)
+    yield sink.drain()
 
 # Config from ENV
-CHDB_HOST = os.getenv('CHDB_HOST', 'localhost')
-CHDB_PORT = os.getenv('CHDB_PORT', '9000')
-CHDB_DATABASE = os.getenv('CHDB_DATABASE', 'logger')
-CHDB_USER = os.getenv('CHDB_USER', 'test')
-CHDB_PASSWORD = os.getenv('CHDB_PASSWORD', 'test')
-LINES_STREAM_LIMIT = int(os.getenv('LINES_STREAM_LIMIT', default_lines_stream_limit()))
-
-db_connection = clickhouse_driver.dbapi.Connection(
-    host=CHDB_HOST,
-    port=CHDB_PORT,
-    database=CHDB_DATABASE,
-    user=CHDB_USER,
-    password=CHDB_PASSWORD,
-    client_name='logger-server-async',
-    settings={'use_numpy': False, 'insert_block_size': 1000}
-)
-
-def create_empty_graph(message="Нет данных для отображения", font_color='#34495e'):
-    fig = go.Figure()
-    fig.add_annotation(
-        text=message,
-        xref="paper", yref="paper",
-        x=0.5, y=0.5,
-        showarrow=False,
-        font=dict(size=20, color=font_color),
-    )
-    fig.update_layout(
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)',
-        xaxis=dict(visible=False),
-        yaxis=dict(visible=False),
-        margin=dict(l=40, r=40, t=20, b=40),
-    )
-    return fig
-
-apache2_regex = re.compile(
-    r'^(?P<ip>\S+)\s-\s-\s\[(?P<timestamp>[^\]]+)\]\s'
-    r'"(?P<method>\S+)\s(?P<path>\S+)\s(?P<protocol>[^"]+)"\s'
-    r'(?P<status>\d+)\s'
-    r'(?P<bytes_sent>\d+)\s'
-    r'"(?P<referrer>[^"]*)"\s'
-    r'"(?P<user_agent>[^"]*)"\s'
-    r'(?P<response_time>\d+)$'
-)
-
-def apache2_parse_log(text: io.TextIOWrapper):
-    line_i = 0
-    for line in text:
-        def parse_datetime(dt_string):
-            dt_string = dt_string.replace("+0300", "").strip()
-            return datetime.datetime.strptime(dt_string, "%Y-%m-%d %H:%M:%S")
-        line_i += 1
-        if line_i % 100000 == 0:
-            print(f"Checkpoint: line {line_i}...")
-        match = apache2_regex.match(line)
-        if match:
-            log_data = match.groupdict()
-            log_data['bytes_sent'] = int(log_data['bytes_sent']) if log_data['bytes_sent'].isdigit() else 0
-            log_data['status'] = int(log_data['status'])
-            log_data['response_time'] = int(log_data['response_time'])
-            log_data['timestamp'] = parse_datetime(log_data['timestamp'])
-            yield log_data
-
-def iterable_to_stream(iterable, buffer_size=io.DEFAULT_BUFFER_SIZE):
-    class IterStream(io.RawIOBase):
-        def __init__(self):
-            self.leftover = None
-        def readable(self):
-            return True
-        def readinto(self, b):
+CHDB_HTTP_PORT = os.getenv('CHDB_HTTP_PORT', '8123')
+CHDB_POOL_SIZE = int(os.getenv('CHDB_POOL_SIZE', 8))
+CHDB_POOL_TIMEOUT = float(os.getenv('CHDB_POOL_TIMEOUT', 10))
+CHDB_POOL_PING_IDLE = 30
+CHDB_QUERY_TIMEOUT = int(os.getenv('CHDB_QUERY_TIMEOUT', 30))
+EXPORT_READ_SIZE = 64 * 1024
+ROLLUPS_ENABLED = os.getenv('ROLLUPS_ENABLED', '1') == '1'
+CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Imports made by other processes (CLI, follow mode) can't bump the generation, so entries also expire
+CACHE_TTL = float(os.getenv('CACHE_TTL', 60))
+GRAPH_POINT_BUDGET = int(os.getenv('GRAPH_POINT_BUDGET', 1000))
+GRAPH_MAX_POINTS = 10000
+PARQUET_ROW_GROUP_SIZE = int(os.getenv('PARQUET_ROW_GROUP_SIZE', 256 * 1024))
+IMPORT_WORKERS = int(os.getenv('IMPORT_WORKERS', 2))
+IMPORT_SPOOL_DIR = os.getenv('IMPORT_SPOOL_DIR', tempfile.gettempdir())
+IMPORT_JOBS_KEEP = 100
+IP_DETAILS_PAGE_SIZE = 100
+IP_DETAILS_MAX_PAGE = 1000
+RETENTION_MONTHS = int(os.getenv('RETENTION_MONTHS', 0))
+RETENTION_INTERVAL = 3600
+
+metrics.histogram('logger_http_request_duration_seconds', "Time until the response starts, per route.")
+metrics.counter('logger_import_read_bytes_total', "Bytes of uploaded logs read by import jobs.")
+metrics.counter('logger_export_bytes_total', "Bytes streamed by the export routes.")
+
+class ClientDisconnected(Exception):
+    pass
+
+class ClickhousePool:
+    # clickhouse_driver.Client runs one query at a time, so every request thread borrows its own
+    def __init__(self, size, client_name, settings=None):
+        self.size = size
+        self.client_name = client_name
+        self.settings = settings
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            client, released_at = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if self.created < self.size:
+                    self.created += 1
+                    return db_client(self.client_name, self.settings)
+            try:
+                client, released_at = self.idle.get(timeout=CHDB_POOL_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError(f"No free ClickHouse connection in {CHDB_POOL_TIMEOUT} seconds.")
+        if client.connection.connected and time.monotonic() - released_at > CHDB_POOL_PING_IDLE:
+            if not client.connection.ping():
+                logger.warning("Pooled ClickHouse connection is dead, reconnecting.")
+                client.disconnect()
+        return client
+
+    def release(self, client):
+        self.idle.put((client, time.monotonic()))
+
+    @contextlib.contextmanager
+    def client(self):
+        client = self.acquire()
+        try:
+            yield client
+        except BaseException:
+            # Connection state is unknown (e.g. a half-read result), next query reconnects
+            client.disconnect()
+            raise
+        finally:
+            self.release(client)
+
+    def stats(self):
+        return {"size": self.size, "created": self.created, "idle": self.idle.qsize()}
+
+def http_client_gone():
+    # Only servers exposing the client socket (werkzeug, gunicorn) allow noticing a disconnect
+    sock = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+def db_query_dataframe(query, params=None, settings=None):
+    # Like Client.query_dataframe, but cancels the query once the HTTP client is gone
+    # and retries once on a broken connection
+    import pandas as pd
+    for attempt in (1, 2):
+        with db_pool.client() as client:
             try:
-                l = len(b)
-                chunk = self.leftover or next(iterable)
-                output, self.leftover = chunk[:l], chunk[l:]
-                b[:len(output)] = output
-                return len(output)
-            except StopIteration:
-                return 0
-    return io.BufferedReader(IterStream(), buffer_size=buffer_size)
-
-def get_db_size():
-    with db_connection.cursor() as cursor:
-        cursor.execute("SELECT count() FROM apache_logs")
-        count = cursor.fetchall()[0][0]
-        cursor.execute("SELECT formatReadableSize(sum(bytes)), sum(bytes) FROM system.parts WHERE active AND table = 'apache_logs'")
-        size_human, size = cursor.fetchall()[0]
-        return count, size, size_human
-
-def print_db_size():
-    count, _, size_human = get_db_size()
-    logger.info(f"Current db status: {count} lines, {size_human} size.")
-
-def tmp_del_after():
-    if len(tmp_files):
-        tmp = tmp_files[-1]
-        os.unlink(tmp.name)
-        tmp_files.remove(tmp)
+                with db_query_metrics(client, 'select'):
+                    progress = client.execute_with_progress(
+                        query, params, with_column_types=True, columnar=True, settings=settings
+                    )
+                    for _ in progress:
+                        if has_request_context() and http_client_gone():
+                            client.cancel()
+                            raise ClientDisconnected()
+                    data, columns = progress.get_result()
+            except (clickhouse_errors.NetworkError, clickhouse_errors.SocketTimeoutError, EOFError):
+                if attempt == 2:
+                    raise
+                logger.warning("ClickHouse connection failed, retrying query on a new one.")
+                # Handled here, so the pool won't reset it: a half-read result would make
+                # the next query on this client fail with PartiallyConsumedQueryError
+                client.disconnect()
+                continue
+        columns = [re.sub(r'\W', '_', name) for name, _ in columns]
+        return pd.DataFrame({col: d for d, col in zip(data, columns)}, columns=columns)
+
+def db_execute(query, params=None, settings=None):
+    with db_pool.client() as client, db_query_metrics(client, 'execute'):
+        return client.execute(query, params, settings=settings)
+
+def db_http_query(query, params=None, settings=None, query_id=None):
+    # Server-side output formats (`FORMAT ...`) are only available over the HTTP interface
+    args = {'database': CHDB_DATABASE, 'cancel_http_readonly_queries_on_client_close': 1}
+    if query_id:
+        args['query_id'] = query_id
+    args.update(settings or {})
+    args.update({f'param_{name}': value for name, value in (params or {}).items()})
+    req = urllib.request.Request(
+        url=f'http://{CHDB_HOST}:{CHDB_HTTP_PORT}/?{urllib.parse.urlencode(args)}',
+        data=query.encode(),
+        headers={'X-ClickHouse-User': CHDB_USER, 'X-ClickHouse-Key': CHDB_PASSWORD},
+    )
+    try:
+        return urllib.request.urlopen(req)
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(f"ClickHouse HTTP query failed: {e.read().decode(errors='replace')}") from e
+
+def db_kill_query(query_id):
+    db_execute("KILL QUERY WHERE query_id = %(query_id)s ASYNC", {'query_id': query_id})
+
+db_pool = ClickhousePool(CHDB_POOL_SIZE, 'logger-server', {'max_execution_time': CHDB_QUERY_TIMEOUT})
+metrics.gauge('logger_clickhouse_pool_connections', "Pooled ClickHouse connections, by state.",
+              lambda: {k: v for k, v in db_pool.stats().items() if k != 'size'}, label='state')
+metrics.gauge('logger_clickhouse_pool_size', "Maximum pooled ClickHouse connections.", lambda: db_pool.stats()['size'])
+
+routes = Blueprint('logger', __name__)
+
+def client_disconnected(e):
+    # Nobody is listening anymore, the query is already cancelled
+    return Response(status=499)
+
+class ImportJob:
+    def __init__(self, path, bytes_total, compression=None):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.compression = compression
+        self.status = 'queued'
+        self.error = None
+        self.bytes_total = bytes_total
+        self.bytes_read = 0
+        self.lines_parsed = 0
+        self.lines_rejected = 0
+        self.rows_inserted = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def read_chunks(self):
+        with open(self.path, 'rb') as file:
+            while chunk := file.read(IMPORT_READ_SIZE):
+                self.bytes_read += len(chunk)
+                metrics.inc('logger_import_read_bytes_total', len(chunk))
+                yield chunk
 
-if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        import_file = sys.argv[1]
-    else:
-        print("Please provide a file to import.")
-        exit(1)
-    if not os.path.isfile(import_file):
-        print(f"File {import_file} is not a file.")
-        exit(2)
-    print_db_size()
-    logger.info(f"Import (local) started on {datetime.datetime.now()}...")
-    with open(import_file, 'r') as file:
-        with db_connection.cursor() as cursor:
-            cursor.execute(
-                operation='INSERT INTO apache_logs VALUES',
-                parameters=apache2_parse_log(file)
-            )
-    print(f"Import (local) completed on {datetime.datetime.now()}.")
-    print_db_size()
-    print("To start web-server, please use WGSI. For example, running dev-server: `python -m flask --app logger run`.")
-    exit(0)
-
-app = Flask(__name__)
-
-@app.route('/')
+    def run(self):
+        self.status = 'running'
+        self.started_at = time.time()
+        logger.info(f"Import job {self.id} started on {datetime.datetime.now()}...")
+        client = db_client('logger-server-import')
+        try:
+            stream = iterable_to_stream(self.read_chunks(), buffer_size=IMPORT_READ_SIZE)
+            with open_decompressed(stream, self.compression) as stream:
+                insert_apache_log(client, io.TextIOWrapper(stream), stats=self)
+            self.status = 'done'
+            logger.info(f"Import job {self.id} completed on {datetime.datetime.now()}: "
+                        f"{self.rows_inserted} rows inserted, {self.lines_rejected} lines rejected.")
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            logger.exception(f"Import job {self.id} failed on {datetime.datetime.now()}!")
+        finally:
+            self.finished_at = time.time()
+            response_cache.bump_generation()
+            client.disconnect()
+            os.unlink(self.path)
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "bytes_total": self.bytes_total,
+            "bytes_read": self.bytes_read,
+            "lines_parsed": self.lines_parsed,
+            "lines_rejected": self.lines_rejected,
+            "rows_inserted": self.rows_inserted,
+            "elapsed": elapsed,
+            "rows_per_second": self.rows_inserted / elapsed if elapsed else 0,
+            "bytes_per_second": self.bytes_read / elapsed if elapsed else 0,
+        }
+
+class ResponseCache:
+    # LRU of serialized responses, dropped whenever the data generation changes
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def bump_generation(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry:
+                self.size -= len(self.entries.pop(key)[2])
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, mimetype, body):
+        with self.lock:
+            # The response was computed while data changed, it may already be stale
+            if generation != self.generation or len(body) > self.max_bytes:
+                return
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[2])
+            self.entries[key] = (time.monotonic(), mimetype, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "generation": self.generation,
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0,
+            }
+
+response_cache = ResponseCache(CACHE_MAX_BYTES, CACHE_TTL)
+metrics.gauge('logger_cache_entries', "Responses in the response cache.", lambda: response_cache.stats()['entries'])
+metrics.gauge('logger_cache_bytes', "Size of the cached responses.", lambda: response_cache.stats()['size'])
+metrics.counter('logger_cache_hits_total', "Response cache hits.", lambda: response_cache.hits)
+metrics.counter('logger_cache_misses_total', "Response cache misses.", lambda: response_cache.misses)
+metrics.gauge('logger_cache_generation', "Data generation, bumped by imports and cleanups.", lambda: response_cache.generation)
+
+def cached_response(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.path, tuple(sorted((k, v.strip()) for k, v in request.args.items(multi=True) if v.strip())))
+        entry = response_cache.get(key)
+        if entry:
+            resp = Response(response=entry[2], status=200, mimetype=entry[1])
+            resp.headers['X-Cache'] = 'HIT'
+            return resp
+        generation = response_cache.generation
+        resp = view(*args, **kwargs)
+        if resp.status_code == 200:
+            response_cache.put(key, generation, resp.mimetype, resp.get_data())
+        resp.headers['X-Cache'] = 'MISS'
+        return resp
+    return wrapper
+
+import_executor = concurrent.futures.ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix='import')
+import_jobs = {}
+import_jobs_lock = threading.Lock()
+metrics.gauge('logger_import_jobs', "Import jobs kept in memory, by status.",
+              lambda: collections.Counter(job.status for job in list(import_jobs.values())), label='status')
+
+def import_job_submit(job):
+    with import_jobs_lock:
+        finished = [j for j in import_jobs.values() if j.finished_at]
+        for j in finished[:-IMPORT_JOBS_KEEP]:
+            del import_jobs[j.id]
+        import_jobs[job.id] = job
+    import_executor.submit(job.run)
+
+@routes.route('/')
 def root():
-    return app.send_static_file('index.html')
+    return current_app.send_static_file('index.html')
 
-@app.route('/favicon.ico')
+@routes.route('/favicon.ico')
 def favicon():
-    return app.send_static_file('favicon.ico')
+    return current_app.send_static_file('favicon.ico')
 
-@app.route('/api/import/apache_log', methods=['POST'])
+@routes.route('/api/import/apache_log', methods=['POST'])
 def import_apache_log():
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding != 'identity' and encoding not in content_encodings:
+        resp = json.dumps({"status": "unsupported_encoding", "encoding": encoding})
+        return Response(response=resp, status=415, mimetype="application/json")
+    spool = tempfile.NamedTemporaryFile(dir=IMPORT_SPOOL_DIR, prefix='import-', suffix='.log', delete=False)
     try:
-        count, _, _ = get_db_size()
-        print_db_size()
-        logging.info(f"Import (web) started on {datetime.datetime.now()}...")
-        def get_stream_bytes():
-            bytes_left = int(request.headers.get('content-length'))
-            chunk_size = 5120
-            while bytes_left > 0:
-                chunk = request.stream.read(chunk_size)
-                bytes_left -= len(chunk)
-                yield chunk
-        stream = io.TextIOWrapper(iterable_to_stream(get_stream_bytes()))
-        with db_connection.cursor() as cursor:
-            cursor.execute(
-                operation='INSERT INTO apache_logs VALUES',
-                parameters=apache2_parse_log(stream)
-            )
-        new_count = count
-        while new_count == count:
-            time.sleep(0.5)
-            new_count, _, _ = get_db_size()
-        logging.info(f"Import (web) completed on {datetime.datetime.now()}.")
-        print_db_size()
+        with spool:
+            shutil.copyfileobj(request.stream, spool, IMPORT_READ_SIZE)
+            size = spool.tell()
     except Exception as e:
-        logging.critical(f"Import (web) failed on {datetime.datetime.now()}!")
+        os.unlink(spool.name)
         raise e
-    resp = json.dumps({"status": "success"})
-    return Response(response=resp, status=200, mimetype="application/json")
-
-@app.route('/api/db/db_size', methods=['GET'])
+    job = ImportJob(spool.name, size, content_encodings.get(encoding))
+    import_job_submit(job)
+    resp = json.dumps({"status": "queued", "job_id": job.id})
+    return Response(response=resp, status=202, mimetype="application/json")
+
+@routes.route('/api/import/jobs/<job_id>', methods=['GET'])
+def import_job_status(job_id):
+    job = import_jobs.get(job_id)
+    if job is None:
+        resp = json.dumps({"status": "not_found"})
+        return Response(response=resp, status=404, mimetype="application/json")
+    return Response(response=json.dumps(job.to_dict()), status=200, mimetype="application/json")
+
+@routes.route('/api/db/db_size', methods=['GET'])
+@cached_response
 def db_size_json():
-    info = get_db_size()
+    with db_pool.client() as client:
+        info = get_db_size(client)
     res = json.dumps({"count": info[0], "size": info[1], "size_human": info[2]})
     return Response(response=res, status=200, mimetype="application/json")
 
-@app.route('/api/db/clean', methods=['POST'])
+def request_timer_start():
+    g.request_started = time.perf_counter()
+
+def request_timer_observe(resp):
+    # Streamed responses (exports) are timed until their first byte
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('logger_http_request_duration_seconds', time.perf_counter() - g.request_started,
+                    route=route, method=request.method, status=resp.status_code)
+    return resp
+
+@routes.route('/metrics')
+def metrics_text():
+    return Response(response=metrics.render(), status=200, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@routes.route('/api/import/rejected', methods=['GET'])
+def import_rejected():
+    return Response(response=json.dumps({"lines": list(rejected_lines)}), status=200, mimetype="application/json")
+
+@routes.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    return Response(response=json.dumps(response_cache.stats()), status=200, mimetype="application/json")
+
+@routes.route('/api/db/clean', methods=['POST'])
 def db_clean():
-    with db_connection.cursor() as cursor:
-        cursor.execute("DELETE FROM apache_logs WHERE ip IS NOT NULL")
-    resp = json.dumps({"status": "success"})
+    # Without a range everything is truncated, otherwise rows with start_time <= timestamp <= end_time are deleted
+    start_time = request.args.get('start_time')
+    end_time = request.args.get('end_time')
+    if bool(start_time) != bool(end_time) or not all(v.isdigit() for v in (start_time or '0', end_time or '0')):
+        resp = json.dumps({"status": "bad_request", "error": "Pass both start_time and end_time (unix seconds), or neither."})
+        return Response(response=resp, status=400, mimetype="application/json")
+    with db_pool.client() as client:
+        if start_time:
+            dropped, deleted = data_delete_range(client, start_time, end_time)
+            result = {"status": "success", "partitions_dropped": dropped, "rows_deleted": deleted}
+        else:
+            data_truncate(client)
+            result = {"status": "success"}
+    response_cache.bump_generation()
+    return Response(response=json.dumps(result), status=200, mimetype="application/json")
+
+@routes.route('/api/db/partitions')
+def db_partitions():
+    with db_pool.client() as client:
+        partitions = [
+            {"partition_id": partition_id, "min_time": min_time, "max_time": max_time, "rows": rows, "bytes": size}
+            for partition_id, min_time, max_time, rows, size in partitions_list(client)
+        ]
+    resp = json.dumps({"retention_months": RETENTION_MONTHS, "partitions": partitions})
+    return Response(response=resp, status=200, mimetype="application/json")
+
+@routes.route('/api/db/retention', methods=['POST'])
+def db_retention():
+    months = request.args.get('months', str(RETENTION_MONTHS))
+    if not months.isdigit() or int(months) < 1:
+        resp = json.dumps({"status": "bad_request", "error": "Pass months >= 1, or set RETENTION_MONTHS."})
+        return Response(response=resp, status=400, mimetype="application/json")
+    with db_pool.client() as client:
+        dropped = retention_apply(client, int(months))
+    if dropped:
+        response_cache.bump_generation()
+    resp = json.dumps({"status": "success", "partitions_dropped": dropped})
     return Response(response=resp, status=200, mimetype="application/json")
 
-@app.route('/api/export/csv/<int:limit>', methods=['GET'])
+def retention_loop():
+    while True:
+        try:
+            with db_pool.client() as client:
+                if retention_apply(client, RETENTION_MONTHS):
+                    response_cache.bump_generation()
+        except Exception:
+            logger.exception("Retention run failed")
+        time.sleep(RETENTION_INTERVAL)
+
+export_names = "ip, timestamp, method, path, protocol, status, bytes_sent, referrer, user_agent, response_time"
+export_columns = f"{ip_text_sql} AS ip, timestamp, method, path, protocol, status, bytes_sent, referrer, user_agent, response_time"
+export_order = "timestamp, ip, method, path, protocol, status, bytes_sent, referrer, user_agent, response_time"
+
+def export_query(limit, args):
+    # Rows are sorted by every column, so the same request always yields the same bytes
+    conditions, params, offset = [], {}, 0
+    if args.get('start_time'):
+        conditions.append("timestamp >= toDateTime({start_time:UInt32})")
+        params['start_time'] = int(args['start_time'])
+    if args.get('end_time'):
+        conditions.append("timestamp <= toDateTime({end_time:UInt32})")
+        params['end_time'] = int(args['end_time'])
+    status = args.get('status', '').lower()
+    if re.fullmatch(r'[1-5]xx', status):
+        conditions.append("intDiv(status, 100) = {status_class:UInt8}")
+        params['status_class'] = int(status[0])
+    elif re.fullmatch(r'\d{3}', status):
+        conditions.append("status = {status:UInt16}")
+        params['status'] = int(status)
+    elif status:
+        raise ValueError(f"Unsupported status filter '{status}'.")
+    if args.get('ip'):
+        conditions.append("ip = {ip:String}")
+        params['ip'] = args['ip'].strip()
+        ipaddress.ip_address(params['ip'])
+    if args.get('path'):
+        conditions.append("startsWith(path, {path:String})")
+        params['path'] = args['path']
+    if args.get('resume'):
+        # Resume token is "<timestamp of the last received row>:<rows received with that timestamp>"
+        resume_ts, _, skip = args['resume'].rpartition(':')
+        # Checked here, a bad value would only fail in ClickHouse once the 200 is sent
+        try:
+            datetime.datetime.strptime(resume_ts, '%Y-%m-%d %H:%M:%S')
+            offset = int(skip)
+            if offset < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError("Invalid resume token, expected '<YYYY-MM-DD hh:mm:ss>:<rows>'.") from None
+        conditions.append("timestamp >= toDateTime({resume_ts:String})")
+        params['resume_ts'] = resume_ts
+    query = f"SELECT {export_columns} FROM apache_logs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {export_order}"
+    if limit:
+        query += f" LIMIT {limit}"
+    if offset:
+        query += f" OFFSET {offset}"
+    return query, params
+
+def export_etag(query, params):
+    state = db_execute("SELECT max(modification_time), sum(rows) FROM system.parts WHERE active AND table = 'apache_logs'")[0]
+    return hashlib.sha1(repr((query, sorted(params.items()), state)).encode()).hexdigest()
+
+def export_csv_length(query, params):
+    length_query = f"SELECT sum(length(formatRow('CSV', {export_names}))) FROM ({query}) FORMAT TabSeparated"
+    with db_http_query(length_query, params) as response:
+        return int(response.read())
+
+@routes.route('/api/export/csv/<int:limit>', methods=['GET'])
 def export_csv(limit: int):
+    try:
+        query, params = export_query(limit, request.args)
+    except ValueError as e:
+        resp = json.dumps({"status": "bad_request", "error": str(e)})
+        return Response(response=resp, status=400, mimetype="application/json")
+    etag = export_etag(query, params)
+    skip_bytes, total = 0, None
+    range_match = re.fullmatch(r'bytes=(\d+)-', request.headers.get('Range', '').strip())
+    if range_match and request.headers.get('If-Range', f'"{etag}"') == f'"{etag}"':
+        skip_bytes = int(range_match[1])
+        total = export_csv_length(query, params)
+        if skip_bytes >= total:
+            resp = Response(status=416)
+            resp.headers['Content-Range'] = f'bytes */{total}'
+            return resp
     def return_data():
-        if limit == 0:
-            sql_req = 'SELECT * FROM apache_logs'
-        else:
-            sql_req = f'SELECT * FROM apache_logs LIMIT {limit}'
-        with db_connection.cursor() as cursor:
-            cursor.set_stream_results(True, 1000)
-            cursor.execute(sql_req)
-            for row in cursor:
-                yield bytes(", ".join([str(i) for i in row]) + "\n", encoding="UTF-8")
-    stream = iterable_to_stream(return_data())
-    if limit and limit <= LINES_STREAM_LIMIT:
-        tmp = tempfile.NamedTemporaryFile(delete_on_close=False)
-        tmp.writelines(stream)
-        tmp.close()
-        tmp_files.append(tmp)
-        resp = send_file(path_or_file=tmp.name, mimetype="text/csv", as_attachment=False, download_name="export.csv")
-        resp.direct_passthrough = False
-        resp.call_on_close(tmp_del_after)
-    else:
-        resp = Response(response=stream, content_type="text/csv")
-        resp.headers['Content-Disposition'] = 'attachment; filename="export.csv"'
+        left_to_skip = skip_bytes
+        query_id = uuid.uuid4().hex
+        try:
+            with db_http_query(query + " FORMAT CSV", params, query_id=query_id) as response:
+                while chunk := response.read(EXPORT_READ_SIZE):
+                    if left_to_skip:
+                        chunk, left_to_skip = chunk[left_to_skip:], max(0, left_to_skip - len(chunk))
+                    if chunk:
+                        metrics.inc('logger_export_bytes_total', len(chunk), format='csv')
+                        yield chunk
+        except GeneratorExit:
+            # Download was interrupted
+            db_kill_query(query_id)
+            raise
+    resp = Response(response=return_data(), content_type="text/csv")
+    resp.headers['Content-Disposition'] = 'attachment; filename="export.csv"'
+    resp.headers['Accept-Ranges'] = 'bytes'
+    resp.headers['ETag'] = f'"{etag}"'
+    if total is not None:
+        resp.status_code = 206
+        resp.headers['Content-Range'] = f'bytes {skip_bytes}-{total - 1}/{total}'
+        resp.headers['Content-Length'] = total - skip_bytes
     return resp
 
-@app.route('/api/export/parquet/<int:limit>')
+@routes.route('/api/export/parquet/<int:limit>')
 def export_parquet(limit: int):
+    query = (
+        f"SELECT {ip_text_sql} AS ip, toDateTime64(timestamp, 0) AS timestamp, method, path, protocol,"
+        " status, bytes_sent, referrer, user_agent, response_time FROM apache_logs"
+    )
+    if limit:
+        query += f" LIMIT {limit}"
+    query += " FORMAT ArrowStream"
     def return_data():
-        with db_connection.cursor() as cursor:
-            if limit == 0:
-                sql_req = 'SELECT * FROM apache_logs'
-            else:
-                sql_req = f'SELECT * FROM apache_logs LIMIT {limit}'
-            cursor.set_stream_results(True, 1000)
-            cursor.execute(sql_req)
-            batches = parquet_get_batches(rows_iterable=cursor, chunk_size=50, schema=parquet_logs_schema)
-            buffer = io.BytesIO()
-            with pq.ParquetWriter(buffer, schema=parquet_logs_schema, compression='zstd') as writer:
-                for batch in batches:
-                    buffer.flush()
-                    writer.write_batch(batch)
-                    buffer.seek(0)
-                    yield buffer.read()
-                buffer.flush()
-            buffer.seek(0)
-            yield buffer.read()
-    stream = iterable_to_stream(return_data())
-    if limit and limit <= LINES_STREAM_LIMIT:
-        tmp = tempfile.NamedTemporaryFile(delete_on_close=False)
-        tmp.writelines(stream)
-        tmp.close()
-        tmp_files.append(tmp)
-        resp = send_file(path_or_file=tmp.name, mimetype="application/vnd.apache.parquet", as_attachment=False, download_name="export.parquet")
-        resp.direct_passthrough = False
-        resp.call_on_close(tmp_del_after)
-    else:
-        resp = Response(response=stream, content_type="application/vnd.apache.parquet")
-        resp.headers['Content-Disposition'] = 'attachment; filename="export.parquet"'
+        import pyarrow as pa
+        settings = {
+            'output_format_arrow_string_as_string': 1,
+            'output_format_arrow_low_cardinality_as_dictionary': 0,
+        }
+        query_id = uuid.uuid4().hex
+        try:
+            with db_http_query(query, settings=settings, query_id=query_id) as response:
+                reader = pa.ipc.open_stream(response)
+                for chunk in parquet_write_batches(reader, parquet_logs_schema(), PARQUET_ROW_GROUP_SIZE):
+                    metrics.inc('logger_export_bytes_total', len(chunk), format='parquet')
+                    yield chunk
+        except GeneratorExit:
+            # Download was interrupted
+            db_kill_query(query_id)
+            raise
+    resp = Response(response=return_data(), content_type="application/vnd.apache.parquet")
+    resp.headers['Content-Disposition'] = 'attachment; filename="export.parquet"'
     return resp
 
-@app.route('/api/db/get_date_range')
+@routes.route('/api/db/get_date_range')
+@cached_response
 def get_date_range():
-    with db_connection.cursor() as cursor:
-        result = cursor._client.query_dataframe("SELECT MIN(timestamp), MAX(timestamp) FROM apache_logs")
-        if result.empty:
-            min_date = datetime.datetime.fromisoformat('2023-01-01').timestamp()
-            max_date = datetime.datetime.fromisoformat('2023-01-01').timestamp()
-        else:
-            min_date = result.iloc[0, 0].timestamp()
-            max_date = result.iloc[0, 1].timestamp()
-        resp = json.dumps({"min_time": min_date, "max_time": max_date})
-        return Response(response=resp, status=200, mimetype="application/json")
+    result = db_query_dataframe("SELECT MIN(timestamp), MAX(timestamp) FROM apache_logs")
+    if result.empty:
+        min_date = datetime.datetime.fromisoformat('2023-01-01').timestamp()
+        max_date = datetime.datetime.fromisoformat('2023-01-01').timestamp()
+    else:
+        min_date = result.iloc[0, 0].timestamp()
+        max_date = result.iloc[0, 1].timestamp()
+    resp = json.dumps({"min_time": min_date, "max_time": max_date})
+    return Response(response=resp, status=200, mimetype="application/json")
 
-@app.route('/api/graph_show/graph1')
-def graph1_show():
+def sql_datetime(dt):
+    return f"toDateTime('{dt.strftime('%Y-%m-%d %H:%M:%S')}')"
+
+def time_range_split(start_time, end_time, rollups=ROLLUPS_ENABLED):
+    # Returns (rollup condition, raw condition): whole hours inside the range
+    # are read from the hourly rollups, the partial hours at its edges from apache_logs
+    if not (start_time and end_time):
+        return ("1", None) if rollups else (None, "1")
+    start = datetime.datetime.fromtimestamp(int(start_time))
+    end = datetime.datetime.fromtimestamp(int(end_time))
+    if not rollups:
+        return None, f"timestamp BETWEEN {sql_datetime(start)} AND {sql_datetime(end)}"
+    hour = datetime.timedelta(hours=1)
+    rollup_start = start.replace(minute=0, second=0)
+    if rollup_start < start:
+        rollup_start += hour
+    rollup_end = (end + datetime.timedelta(seconds=1)).replace(minute=0, second=0)
+    if rollup_start >= rollup_end:
+        return None, f"timestamp BETWEEN {sql_datetime(start)} AND {sql_datetime(end)}"
+    raw_conditions = []
+    if start < rollup_start:
+        raw_conditions.append(f"(timestamp >= {sql_datetime(start)} AND timestamp < {sql_datetime(rollup_start)})")
+    if rollup_end <= end:
+        raw_conditions.append(f"(timestamp >= {sql_datetime(rollup_end)} AND timestamp <= {sql_datetime(end)})")
+    rollup_condition = f"hour >= {sql_datetime(rollup_start)} AND hour < {sql_datetime(rollup_end)}"
+    return rollup_condition, " OR ".join(raw_conditions) or None
+
+status_group_sql = """CASE
+    WHEN {class_expr} = 2 THEN '2xx (Успешные)'
+    WHEN {class_expr} = 3 THEN '3xx (Перенаправления)'
+    WHEN {class_expr} = 4 THEN '4xx (Клиентские ошибки)'
+    WHEN {class_expr} = 5 THEN '5xx (Серверные ошибки)'
+    ELSE 'Другие'
+END"""
+
+# Every graph: (query over apache_logs, same query over a rollup, outer query merging both)
+graph_queries = {
+    'graph1': (
+        "SELECT {bucket} AS date, count() AS total_requests FROM apache_logs WHERE {where} GROUP BY date",
+        "SELECT {bucket} AS date, sum(requests) AS total_requests FROM apache_logs_hourly WHERE {where} GROUP BY date",
+        "SELECT date, sum(total_requests) AS total_requests FROM ({union}) GROUP BY date ORDER BY date",
+    ),
+    'graph2': (
+        "SELECT {bucket} AS date, count() AS total_failures FROM apache_logs"
+        " WHERE status >= 400 AND ({where}) GROUP BY date",
+        "SELECT {bucket} AS date, sum(requests) AS total_failures FROM apache_logs_hourly"
+        " WHERE status_class >= 4 AND ({where}) GROUP BY date",
+        "SELECT date, sum(total_failures) AS total_failures FROM ({union}) GROUP BY date ORDER BY date",
+    ),
+    'graph3': (
+        f"SELECT {ip_text_sql} AS ip, count() AS request_count"
+        " FROM apache_logs WHERE {where} GROUP BY ip",
+        "SELECT ip, sum(requests) AS request_count FROM apache_logs_ip_hourly WHERE {where} GROUP BY ip",
+        "SELECT ip, sum(request_count) AS request_count FROM ({union}) GROUP BY ip ORDER BY request_count DESC, ip LIMIT 10",
+    ),
+    'graph4': (
+        f"SELECT {status_group_sql.format(class_expr='intDiv(status, 100)')} AS status_group, count() AS count"
+        " FROM apache_logs WHERE {where} GROUP BY status_group",
+        f"SELECT {status_group_sql.format(class_expr='status_class')} AS status_group, sum(requests) AS count"
+        " FROM apache_logs_hourly WHERE {where} GROUP BY status_group",
+        "SELECT status_group, sum(count) AS count FROM ({union}) GROUP BY status_group ORDER BY status_group",
+    ),
+    'graph5': (
+        "SELECT {bucket} AS date, sum(response_time) AS response_time_sum, count() AS requests"
+        " FROM apache_logs WHERE {where} GROUP BY date",
+        "SELECT {bucket} AS date, sum(response_time_sum) AS response_time_sum, sum(requests) AS requests"
+        " FROM apache_logs_hourly WHERE {where} GROUP BY date",
+        "SELECT date, sum(response_time_sum) / sum(requests) AS avg_response_time FROM ({union}) GROUP BY date ORDER BY date",
+    ),
+    'heatmap': (
+        "SELECT toDayOfWeek(timestamp) AS day_of_week, toHour(timestamp) AS hour_of_day, count() AS request_count"
+        " FROM apache_logs WHERE {where} GROUP BY day_of_week, hour_of_day",
+        "SELECT toDayOfWeek(hour) AS day_of_week, toHour(hour) AS hour_of_day, sum(requests) AS request_count"
+        " FROM apache_logs_hourly WHERE {where} GROUP BY day_of_week, hour_of_day",
+        "SELECT day_of_week, hour_of_day AS hour, sum(request_count) AS request_count FROM ({union})"
+        " GROUP BY day_of_week, hour_of_day ORDER BY day_of_week, hour_of_day",
+    ),
+    # graph1, graph2 and graph5 in a single pass, for the dashboard
+    'daily': (
+        "SELECT {bucket} AS date, count() AS day_requests, countIf(status >= 400) AS day_failures,"
+        " sum(response_time) AS response_time_sum FROM apache_logs WHERE {where} GROUP BY date",
+        "SELECT {bucket} AS date, sum(requests) AS day_requests, sumIf(requests, status_class >= 4) AS day_failures,"
+        " sum(response_time_sum) AS response_time_sum FROM apache_logs_hourly WHERE {where} GROUP BY date",
+        "SELECT date, sum(day_requests) AS total_requests, sum(day_failures) AS total_failures,"
+        " sum(response_time_sum) / sum(day_requests) AS avg_response_time FROM ({union}) GROUP BY date ORDER BY date",
+    ),
+}
+
+# Time series buckets, finest first: (seconds, expression)
+graph_buckets = {
+    'minute': (60, "toStartOfMinute({column})"),
+    '5min': (5 * 60, "toStartOfFiveMinutes({column})"),
+    'hour': (3600, "toStartOfHour({column})"),
+    'day': (86400, "toDate({column})"),
+    'week': (7 * 86400, "toMonday({column})"),
+}
+# graph name: column to downsample
+graph_series = {
+    'graph1': 'total_requests',
+    'graph2': 'total_failures',
+    'graph5': 'avg_response_time',
+}
+
+def graph_time_span(start_time, end_time):
+    if start_time and end_time:
+        return int(end_time) - int(start_time)
+    # Whole table: the partition min/max index answers without reading data
+    result = db_execute(
+        "SELECT toUnixTimestamp(min(min_time)), toUnixTimestamp(max(max_time)) FROM system.parts"
+        " WHERE database = currentDatabase() AND table = 'apache_logs' AND active"
+    )
+    return result[0][1] - result[0][0] if result else 0
+
+def graph_bucket(start_time, end_time, points):
+    # The finest bucket that keeps the series within the point budget
+    span = graph_time_span(start_time, end_time)
+    for bucket, (seconds, _) in graph_buckets.items():
+        if span / seconds <= points:
+            return bucket
+    return bucket
+
+def graph_points():
+    points = int(request.args.get('points', GRAPH_POINT_BUDGET))
+    return min(max(points, 10), GRAPH_MAX_POINTS)
+
+def lttb_indices(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: per bucket keep the point forming the largest
+    # triangle with the previous kept point and the next bucket's average
+    import numpy as np
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(areas.argmax())
+        indices[i + 1] = a
+    return indices
+
+def graph_downsample(df, column, points):
+    import pandas as pd
+    if len(df) <= points:
+        return df
+    x = pd.to_datetime(df['date']).astype('int64').to_numpy(dtype=float)
+    y = df[column].to_numpy(dtype=float)
+    return df.iloc[lttb_indices(x, y, points)].reset_index(drop=True)
+
+def graph_query(name, start_time, end_time, bucket='day'):
+    raw_select, rollup_select, outer = graph_queries[name]
+    seconds, bucket_expr = graph_buckets[bucket]
+    # Rollups are hourly: finer buckets are answered from apache_logs alone
+    rollup_condition, raw_condition = time_range_split(start_time, end_time, ROLLUPS_ENABLED and seconds >= 3600)
+    selects = []
+    if rollup_condition:
+        selects.append(rollup_select.format(where=rollup_condition, bucket=bucket_expr.format(column='hour')))
+    if raw_condition:
+        selects.append(raw_select.format(where=raw_condition, bucket=bucket_expr.format(column='timestamp')))
+    return outer.format(union=" UNION ALL ".join(selects))
+
+def graph_dataframe(name, start_time, end_time, bucket='day'):
+    return db_query_dataframe(graph_query(name, start_time, end_time, bucket))
+
+graph_names = ('graph1', 'graph2', 'graph3', 'graph4', 'graph5', 'heatmap')
+
+# Data-only chart formats: the frontend applies the figure templates itself
+graph_formats = ('figure', 'json', 'arrow')
+
+def graph_columns(df):
+    # Columnar JSON: one array per column, dates and strings as text
+    import pandas as pd
+    return {
+        column: (df[column] if pd.api.types.is_numeric_dtype(df[column]) else df[column].astype(str)).tolist()
+        for column in df.columns
+    }
+
+def graph_arrow(df):
+    import pyarrow as pa
+    sink = pa.BufferOutputStream()
+    table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def graph_bad_request(error):
+    resp = json.dumps({"status": "bad_request", "error": error})
+    return Response(response=resp, status=400, mimetype="application/json")
+
+def graph_response(name):
+    fmt = request.args.get('format', 'figure')
+    if fmt not in graph_formats:
+        return graph_bad_request(f"Unsupported format '{fmt}', expected one of: {', '.join(graph_formats)}.")
+    try:
+        points = graph_points()
+    except ValueError:
+        return graph_bad_request("'points' must be an integer.")
     start_time = request.args.get('start_time')
     end_time = request.args.get('end_time')
-    with db_connection.cursor() as cursor:
-        query = "SELECT toDate(timestamp) as date, COUNT(*) as total_requests FROM apache_logs WHERE 1=1"
-        if start_time and end_time:
-            start_date = datetime.datetime.fromtimestamp(int(start_time)).strftime("%Y-%m-%d %H:%M:%S")
-            end_date = datetime.datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
-            query += f" AND timestamp BETWEEN toDateTime('{start_date}') AND toDateTime('{end_date}')"
-        query += " GROUP BY date ORDER BY date"
-        df = cursor._client.query_dataframe(query)
-        if df.empty:
-            fig = create_empty_graph("Нет данных о запросах")
-        else:
-            fig = px.line(df, x='date', y='total_requests', title="График запросов", line_shape='linear')
-            fig.update_layout(xaxis_title="Дата", yaxis_title="Запросы", showlegend=False)
-        graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-        return Response(response=graphJSON, status=200, mimetype="application/json")
+    if name in graph_series:
+        df = graph_dataframe(name, start_time, end_time, graph_bucket(start_time, end_time, points))
+        df = graph_downsample(df, graph_series[name], points)
+    else:
+        df = graph_dataframe(name, start_time, end_time)
+    if fmt == 'arrow':
+        return Response(response=graph_arrow(df), status=200, mimetype="application/vnd.apache.arrow.stream")
+    if fmt == 'json':
+        resp = json.dumps(graph_columns(df), separators=(',', ':'))
+        return Response(response=resp, status=200, mimetype="application/json")
+    import charts
+    graphJSON = charts.figures_json(charts.graph_figures[name](df))
+    return Response(response=graphJSON, status=200, mimetype="application/json")
+
+@routes.route('/api/graph_show/graph1')
+@cached_response
+def graph1_show():
+    return graph_response('graph1')
 
-@app.route('/api/graph_show/graph2')
+@routes.route('/api/graph_show/graph2')
+@cached_response
 def graph2_show():
-    start_time = request.args.get('start_time')
-    end_time = request.args.get('end_time')
-    with db_connection.cursor() as cursor:
-        query = "SELECT toDate(timestamp) as date, COUNT(*) as total_failures FROM apache_logs WHERE status >= 400"
-        if start_time and end_time:
-            start_date = datetime.datetime.fromtimestamp(int(start_time)).strftime("%Y-%m-%d %H:%M:%S")
-            end_date = datetime.datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
-            query += f" AND timestamp BETWEEN toDateTime('{start_date}') AND toDateTime('{end_date}')"
-        query += " GROUP BY date ORDER BY date"
-        df = cursor._client.query_dataframe(query)
-        if df.empty:
-            fig = create_empty_graph("Нет данных об отказах")
-        else:
-            fig = px.line(df, x='date', y='total_failures', title="График отказов", line_shape='linear')
-            fig.update_layout(xaxis_title="Дата", yaxis_title="Отказы", showlegend=False)
-        graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-        return Response(response=graphJSON, status=200, mimetype="application/json")
+    return graph_response('graph2')
 
-@app.route('/api/graph_show/graph3')
+@routes.route('/api/graph_show/graph3')
+@cached_response
 def graph3_show():
-    start_time = request.args.get('start_time')
-    end_time = request.args.get('end_time')
-    with db_connection.cursor() as cursor:
-        query = "SELECT ip, COUNT(*) as request_count FROM apache_logs WHERE 1=1"
-        if start_time and end_time:
-            start_date = datetime.datetime.fromtimestamp(int(start_time)).strftime("%Y-%m-%d %H:%M:%S")
-            end_date = datetime.datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
-            query += f" AND timestamp BETWEEN toDateTime('{start_date}') AND toDateTime('{end_date}')"
-        query += " GROUP BY ip ORDER BY request_count DESC LIMIT 10"
-        df = cursor._client.query_dataframe(query)
-        if df.empty:
-            fig = create_empty_graph("Нет данных о топ-10 IP")
-        else:
-            fig = px.bar(df, x='ip', y='request_count', title="График топ-10 IP", text_auto=True)
-            fig.update_layout(xaxis_title="IP", yaxis_title="Запросы", showlegend=False)
-        graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-        return Response(response=graphJSON, status=200, mimetype="application/json")
+    return graph_response('graph3')
 
-@app.route('/api/graph_show/graph4')
+@routes.route('/api/graph_show/graph4')
+@cached_response
 def graph4_show():
-    start_time = request.args.get('start_time')
-    end_time = request.args.get('end_time')
-    with db_connection.cursor() as cursor:
-        query = """
-        SELECT 
-            CASE 
-                WHEN status BETWEEN 200 AND 299 THEN '2xx (Успешные)'
-                WHEN status BETWEEN 300 AND 399 THEN '3xx (Перенаправления)'
-                WHEN status BETWEEN 400 AND 499 THEN '4xx (Клиентские ошибки)'
-                WHEN status BETWEEN 500 AND 599 THEN '5xx (Серверные ошибки)'
-                ELSE 'Другие'
-            END as status_group,
-            COUNT(*) as count
-        FROM apache_logs
-        WHERE 1=1
-        """
-        if start_time and end_time:
-            start_date = datetime.datetime.fromtimestamp(int(start_time)).strftime("%Y-%m-%d %H:%M:%S")
-            end_date = datetime.datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
-            query += f" AND timestamp BETWEEN toDateTime('{start_date}') AND toDateTime('{end_date}')"
-        query += " GROUP BY status_group"
-        df = cursor._client.query_dataframe(query)
-        if df.empty:
-            fig = create_empty_graph("Нет данных о кодах состояния")
-        else:
-            fig = px.pie(df, names='status_group', values='count', title="Распределение кодов состояния")
-            fig.update_traces(textinfo='percent+label')
-            fig.update_layout(showlegend=True)
-        graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-        return Response(response=graphJSON, status=200, mimetype="application/json")
+    return graph_response('graph4')
 
-@app.route('/api/graph_show/graph5')
+@routes.route('/api/graph_show/graph5')
+@cached_response
 def graph5_show():
-    start_time = request.args.get('start_time')
-    end_time = request.args.get('end_time')
-    with db_connection.cursor() as cursor:
-        query = """
-        SELECT toDate(timestamp) as date, AVG(response_time) as avg_response_time
-        FROM apache_logs
-        WHERE 1=1
-        """
-        if start_time and end_time:
-            start_date = datetime.datetime.fromtimestamp(int(start_time)).strftime("%Y-%m-%d %H:%M:%S")
-            end_date = datetime.datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
-            query += f" AND timestamp BETWEEN toDateTime('{start_date}') AND toDateTime('{end_date}')"
-        query += " GROUP BY date ORDER BY date"
-        df = cursor._client.query_dataframe(query)
-        if df.empty:
-            fig = create_empty_graph("Нет данных о времени ответа")
-        else:
-            fig = px.line(df, x='date', y='avg_response_time', title="Среднее время ответа по дням", line_shape='linear')
-            fig.update_layout(xaxis_title="Дата", yaxis_title="Среднее время ответа (мс)", showlegend=False)
-        graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-        return Response(response=graphJSON, status=200, mimetype="application/json")
+    return graph_response('graph5')
 
-@app.route('/api/graph_show/heatmap')
+@routes.route('/api/graph_show/heatmap')
+@cached_response
 def graph_heatmap():
-    with db_connection.cursor() as cursor:
-        query = """
-        SELECT 
-            toDayOfWeek(timestamp) AS day_of_week,
-            toHour(timestamp) AS hour,
-            COUNT(*) AS request_count
-        FROM apache_logs
-        GROUP BY day_of_week, hour
-        ORDER BY day_of_week, hour
-        """
-        df = cursor._client.query_dataframe(query)
-        if df.empty:
-            fig = create_empty_graph("Нет данных для тепловой карты")
-        else:
-            # Pivot: дни — строки, часы — столбцы
-            df_pivot = df.pivot(index='day_of_week', columns='hour', values='request_count').fillna(0)
-            # Переименуем дни недели в русские
-            days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-            fig = go.Figure(data=go.Heatmap(
-                z=df_pivot.values,
-                x=df_pivot.columns.astype(str),
-                y=days,
-                colorscale='YlGnBu'
-            ))
-            fig.update_layout(
-                title="Тепловая карта запросов по дням и часам",
-                xaxis_title="Час",
-                yaxis_title="День недели",
-                margin=dict(l=40, r=40, t=40, b=40),
-            )
-        graphJSON = json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
-        return Response(response=graphJSON, status=200, mimetype="application/json")
-
-@app.route('/api/details/ip/<ip>')
+    return graph_response('heatmap')
+
+dashboard_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='dashboard')
+
+def dashboard_dataframes(start_time, end_time, points):
+    bucket = graph_bucket(start_time, end_time, points)
+    # All chart queries run concurrently, each on its own pooled connection.
+    # Every task gets its own copy of the request context for the disconnect check.
+    def query(name):
+        return graph_dataframe(name, start_time, end_time, bucket)
+    futures = {
+        name: dashboard_executor.submit(copy_current_request_context(query), name)
+        for name in ('daily', 'graph3', 'graph4', 'heatmap')
+    }
+    dfs = {name: future.result() for name, future in futures.items()}
+    daily = dfs.pop('daily')
+    dfs['graph1'] = daily[['date', 'total_requests']]
+    dfs['graph2'] = daily.loc[daily['total_failures'] > 0, ['date', 'total_failures']]
+    dfs['graph5'] = daily[['date', 'avg_response_time']]
+    for name, column in graph_series.items():
+        dfs[name] = graph_downsample(dfs[name], column, points)
+    return dfs
+
+@routes.route('/api/dashboard')
+@cached_response
+def dashboard():
+    fmt = request.args.get('format', 'figure')
+    if fmt not in ('figure', 'json'):
+        return graph_bad_request(f"Unsupported format '{fmt}', expected one of: figure, json.")
+    try:
+        points = graph_points()
+    except ValueError:
+        return graph_bad_request("'points' must be an integer.")
+    dfs = dashboard_dataframes(request.args.get('start_time'), request.args.get('end_time'), points)
+    if fmt == 'json':
+        resp = json.dumps({name: graph_columns(dfs[name]) for name in graph_names}, separators=(',', ':'))
+        return Response(response=resp, status=200, mimetype="application/json")
+    import charts
+    resp = charts.figures_json({name: charts.graph_figures[name](dfs[name]) for name in graph_names})
+    return Response(response=resp, status=200, mimetype="application/json")
+
+ip_details_columns = "timestamp, method, path, status, bytes_sent, response_time"
+
+@routes.route('/api/details/ip/<ip>')
 def ip_details(ip):
+    # Newest first, read through the ip_lookup projection. Further pages are requested with
+    # cursor="<timestamp of the last row>:<rows returned with that timestamp>" from next_cursor.
+    conditions, params, offset = ["ip = %(ip)s"], {'ip': ip.strip()}, 0
     start_time = request.args.get('start_time')
     end_time = request.args.get('end_time')
-    with db_connection.cursor() as cursor:
-        query = """
-        SELECT timestamp, method, path, status, bytes_sent, response_time
-        FROM apache_logs
-        WHERE ip = %s
-        """
+    cursor = request.args.get('cursor')
+    try:
+        # The ip column is IPv6: ClickHouse fails on anything that isn't an address
+        ipaddress.ip_address(params['ip'])
+        limit = min(max(int(request.args.get('limit', IP_DETAILS_PAGE_SIZE)), 1), IP_DETAILS_MAX_PAGE)
         if start_time and end_time:
-            start_date = datetime.datetime.fromtimestamp(int(start_time)).strftime("%Y-%m-%d %H:%M:%S")
-            end_date = datetime.datetime.fromtimestamp(int(end_time)).strftime("%Y-%m-%d %H:%M:%S")
-            query += f" AND timestamp BETWEEN toDateTime('{start_date}') AND toDateTime('{end_date}')"
-        query += " ORDER BY timestamp DESC LIMIT 100"
-        safe_ip = ip.strip()
-        df = cursor._client.query_dataframe(query, parameters=[safe_ip])
-        result = df.to_dict(orient='records')
-    return Response(response=json.dumps(result), status=200, mimetype="application/json")
+            conditions.append("timestamp BETWEEN toDateTime(%(start_time)s) AND toDateTime(%(end_time)s)")
+            params['start_time'] = int(start_time)
+            params['end_time'] = int(end_time)
+        if cursor:
+            cursor_ts, _, skip = cursor.rpartition(':')
+            datetime.datetime.strptime(cursor_ts, '%Y-%m-%d %H:%M:%S')
+            offset = int(skip)
+            if offset < 0:
+                raise ValueError
+            conditions.append("timestamp <= toDateTime(%(cursor_ts)s)")
+            params['cursor_ts'] = cursor_ts
+    except ValueError:
+        resp = json.dumps({"status": "bad_request", "error": "Invalid IP address, limit, time range or cursor."})
+        return Response(response=resp, status=400, mimetype="application/json")
+    query = (
+        f"SELECT {ip_details_columns} FROM apache_logs WHERE {' AND '.join(conditions)}"
+        f" ORDER BY timestamp DESC, method, path, status, bytes_sent, response_time LIMIT {limit} OFFSET {offset}"
+    )
+    # Otherwise ClickHouse prefers reading the base table backwards in timestamp order over the projection
+    df = db_query_dataframe(query, params, settings={'optimize_read_in_order': 0})
+    rows = df.astype({'timestamp': str}).to_dict(orient='records')
+    next_cursor = None
+    if len(rows) == limit:
+        last_ts = rows[-1]['timestamp']
+        same_ts = sum(1 for row in rows if row['timestamp'] == last_ts)
+        if cursor and cursor_ts == last_ts:
+            same_ts += offset
+        next_cursor = f"{last_ts}:{same_ts}"
+    resp = json.dumps({"rows": rows, "next_cursor": next_cursor})
+    return Response(response=resp, status=200, mimetype="application/json")
+
+def create_app():
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+    app.register_error_handler(ClientDisconnected, client_disconnected)
+    app.before_request(request_timer_start)
+    app.after_request(request_timer_observe)
+    if RETENTION_MONTHS:
+        threading.Thread(target=retention_loop, name='retention', daemon=True).start()
+    return app
+
+if __name__ == "__main__":
+    # Kept for `python3 logger.py file.log`, importer.py starts faster
+    import importer
+    importer.main()
@@ -39,13 +39,14 @@ async function apacheLogUpload(file, elemProgress, elemMessage) {
     req.upload.addEventListener('load', async function (evt) {
         elemProgress.style.display = 'none';
         elemProgress.setAttribute('value', 0);
-        elemMessage.textContent = "File uploaded. Waiting DB update...";
+        elemMessage.textContent = "File uploaded. Waiting for import job...";
     });
     req.addEventListener('readystatechange', async function (evt) {
         if (req.readyState === XMLHttpRequest.DONE) {
             const status = req.status;
-            if (status === 0 || (status >= 200 && status < 400)) {
-                elemMessage.textContent = "Import complete.";
+            if (status >= 200 && status < 400) {
+                const got_data = JSON.parse(req.responseText);
+                await importJobWait(got_data['job_id'], elemMessage);
                 getDBstatus("import");
             } else {
                 elemMessage.textContent = "FAILED TO UPLOAD!";
@@ -57,6 +58,24 @@ async function apacheLogUpload(file, elemProgress, elemMessage) {
     req.send(file);
 }
 
+async function importJobWait(jobId, elemMessage) {
+    while (true) {
+        const response = await fetch('/api/import/jobs/' + jobId);
+        const job = await response.json();
+        if (job['status'] === 'done') {
+            dashboardCache = {};
+            elemMessage.textContent = "Import complete: " + job['rows_inserted'] + " rows inserted, " + job['lines_rejected'] + " lines rejected.";
+            return;
+        }
+        if (!response.ok || job['status'] === 'failed') {
+            elemMessage.textContent = "IMPORT FAILED! " + (job['error'] || "");
+            return;
+        }
+        elemMessage.textContent = "Importing: " + job['lines_parsed'] + " lines parsed, " + job['rows_inserted'] + " rows inserted (" + Math.round(job['rows_per_second']) + " rows/s)...";
+        await sleep(1000);
+    }
+}
+
 function getDBstatus(targetPageId) {
     const elem_count = document.querySelector('#' + targetPageId + ' article p:nth-of-type(1) b');
     const elem_size = document.querySelector('#' + targetPageId + ' article p:nth-of-type(2) b');
@@ -95,22 +114,104 @@ function getDBDateRange(targetPageId) {
     });
 }
 
+// Шаблоны графиков: сервер отдаёт только столбцы данных (format=json)
+function emptyFigure(message) {
+    return {
+        data: [],
+        layout: {
+            annotations: [{
+                text: message, xref: 'paper', yref: 'paper', x: 0.5, y: 0.5,
+                showarrow: false, font: { size: 20, color: '#34495e' },
+            }],
+            plot_bgcolor: 'rgba(0,0,0,0)',
+            paper_bgcolor: 'rgba(0,0,0,0)',
+            xaxis: { visible: false },
+            yaxis: { visible: false },
+            margin: { l: 40, r: 40, t: 20, b: 40 },
+        },
+    };
+}
+
+function lineFigure(x, y, title, xTitle, yTitle) {
+    return {
+        data: [{ type: 'scatter', mode: 'lines', x: x, y: y, line: { shape: 'linear' } }],
+        layout: { title: { text: title }, xaxis: { title: { text: xTitle } }, yaxis: { title: { text: yTitle } }, showlegend: false },
+    };
+}
+
+const graphTemplates = {
+    graph1: d => d.date.length === 0 ? emptyFigure("Нет данных о запросах")
+        : lineFigure(d.date, d.total_requests, "График запросов", "Дата", "Запросы"),
+    graph2: d => d.date.length === 0 ? emptyFigure("Нет данных об отказах")
+        : lineFigure(d.date, d.total_failures, "График отказов", "Дата", "Отказы"),
+    graph3: d => d.ip.length === 0 ? emptyFigure("Нет данных о топ-10 IP") : {
+        data: [{ type: 'bar', x: d.ip, y: d.request_count, text: d.request_count, textposition: 'auto' }],
+        layout: { title: { text: "График топ-10 IP" }, xaxis: { title: { text: "IP" }, type: 'category' }, yaxis: { title: { text: "Запросы" } }, showlegend: false },
+    },
+    graph4: d => d.status_group.length === 0 ? emptyFigure("Нет данных о кодах состояния") : {
+        data: [{ type: 'pie', labels: d.status_group, values: d.count, textinfo: 'percent+label' }],
+        layout: { title: { text: "Распределение кодов состояния" }, showlegend: true },
+    },
+    graph5: d => d.date.length === 0 ? emptyFigure("Нет данных о времени ответа")
+        : lineFigure(d.date, d.avg_response_time, "Среднее время ответа", "Дата", "Среднее время ответа (мс)"),
+    heatmap: d => {
+        if (d.hour.length === 0) return emptyFigure("Нет данных для тепловой карты");
+        const hours = [...new Set(d.hour)].sort((a, b) => a - b);
+        const days = [1, 2, 3, 4, 5, 6, 7];
+        const z = days.map(() => hours.map(() => 0));
+        d.hour.forEach((hour, i) => {
+            z[days.indexOf(d.day_of_week[i])][hours.indexOf(hour)] = d.request_count[i];
+        });
+        return {
+            data: [{ type: 'heatmap', z: z, x: hours.map(String), y: ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"], colorscale: 'YlGnBu' }],
+            layout: { title: { text: "Тепловая карта запросов по дням и часам" }, xaxis: { title: { text: "Час" } }, yaxis: { title: { text: "День недели" } }, margin: { l: 40, r: 40, t: 40, b: 40 } },
+        };
+    },
+};
+
+// Все графики за один диапазон приходят одним ответом /api/dashboard.
+// Ответ хранится столько же, сколько в серверном кэше (CACHE_TTL), потом запрашивается заново
+var DASHBOARD_CACHE_TTL = 60 * 1000;
+var dashboardCache = {};
+
+function getDashboard(query) {
+    var now = Date.now();
+    for (var key in dashboardCache) {
+        if (now - dashboardCache[key].time > DASHBOARD_CACHE_TTL) {
+            delete dashboardCache[key];
+        }
+    }
+    if (!(query in dashboardCache)) {
+        var entry = { time: now };
+        entry.promise = fetch('/api/dashboard?format=json' + query).then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        });
+        entry.promise.catch(() => {
+            if (dashboardCache[query] === entry) {
+                delete dashboardCache[query];
+            }
+        });
+        dashboardCache[query] = entry;
+    }
+    return dashboardCache[query].promise;
+}
+
 function drawGraph(targetPageId, params) {
     var graph = document.querySelector('#' + targetPageId + ' div.chart');
     var progress = document.querySelector('#' + targetPageId + ' progress');
-    var url = '/api/graph_show/' + targetPageId;
+    var query = '';
     if (['graph1', 'graph2', 'graph3'].includes(targetPageId)) {
         var time_start = document.querySelector('#' + targetPageId + ' form input[name=date_start]');
         var time_end = document.querySelector('#' + targetPageId + ' form input[name=date_end]');
         var start_time = time_start.valueAsNumber ? Math.floor(time_start.valueAsNumber / 1000) : 0;
         var end_time = time_end.valueAsNumber ? Math.floor(time_end.valueAsNumber / 1000) : 0;
-        url += `?start_time=${start_time}&end_time=${end_time}`;
+        query = `&start_time=${start_time}&end_time=${end_time}`;
     }
-    fetch(url).then(async response => {
-        if (!response.ok) {
-            throw new Error(`HTTP error! status: ${response.status}`);
-        }
-        const got_data = await response.json();
+    getDashboard(query).then(dashboard => {
+        const got_data = graphTemplates[targetPageId](dashboard[targetPageId]);
         graph.style.display = 'block';
         var layout = got_data.layout;
         layout['autosize'] = true;
@@ -124,42 +225,7 @@ function drawGraph(targetPageId, params) {
             graph.on('plotly_click', function(data) {
                 if (data.points.length > 0) {
                     var ip = data.points[0].x;
-                    fetch(`/api/details/ip/${ip}`)
-                        .then(response => {
-                            if (!response.ok) {
-                                throw new Error(`HTTP error! status: ${response.status}`);
-                            }
-                            return response.json();
-                        })
-                        .then(details => {
-                            var tableDiv = document.getElementById('ip-details-table');
-                            tableDiv.innerHTML = '';
-                            var table = document.createElement('table');
-                            table.innerHTML = `
-                                <tr>
-                                    <th>Timestamp</th>
-                                    <th>Method</th>
-                                    <th>Path</th>
-                                    <th>Status</th>
-                                    <th>Bytes Sent</th>
-                                    <th>Response Time</th>
-                                </tr>
-                            `;
-                            details.forEach(row => {
-                                table.innerHTML += `
-                                    <tr>
-                                        <td>${row.timestamp}</td>
-                                        <td>${row.method}</td>
-                                        <td>${row.path}</td>
-                                        <td>${row.status}</td>
-                                        <td>${row.bytes_sent}</td>
-                                        <td>${row.response_time}</td>
-                                    </tr>
-                                `;
-                            });
-                            tableDiv.appendChild(table);
-                        })
-                        .catch(error => console.error('Ошибка загрузки деталей:', error));
+                    ipDetailsLoad(ip, query, null);
                 }
             });
         }
@@ -170,6 +236,57 @@ function drawGraph(targetPageId, params) {
     });
 }
 
+// Детали по IP: страницы по курсору next_cursor, кнопка «Показать ещё» догружает следующую
+function ipDetailsLoad(ip, query, cursor) {
+    var url = `/api/details/ip/${encodeURIComponent(ip)}?` + query.replace(/^&/, '');
+    if (cursor) {
+        url += '&cursor=' + encodeURIComponent(cursor);
+    }
+    fetch(url)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(details => {
+            var tableDiv = document.getElementById('ip-details-table');
+            var table = tableDiv.querySelector('table');
+            if (!cursor || !table) {
+                tableDiv.innerHTML = '';
+                table = document.createElement('table');
+                table.innerHTML = `
+                    <tr>
+                        <th>Timestamp</th>
+                        <th>Method</th>
+                        <th>Path</th>
+                        <th>Status</th>
+                        <th>Bytes Sent</th>
+                        <th>Response Time</th>
+                    </tr>
+                `;
+                tableDiv.appendChild(table);
+            }
+            details.rows.forEach(row => {
+                var tr = table.insertRow();
+                [row.timestamp, row.method, row.path, row.status, row.bytes_sent, row.response_time].forEach(value => {
+                    tr.insertCell().textContent = value;
+                });
+            });
+            var more = tableDiv.querySelector('button');
+            if (more) {
+                more.remove();
+            }
+            if (details.next_cursor) {
+                more = document.createElement('button');
+                more.textContent = 'Показать ещё';
+                more.addEventListener('click', () => ipDetailsLoad(ip, query, details.next_cursor));
+                tableDiv.appendChild(more);
+            }
+        })
+        .catch(error => console.error('Ошибка загрузки деталей:', error));
+}
+
 function destroyGraph(targetPageId, params) {
     var graph = document.querySelector('#' + targetPageId + ' div.chart');
     var progress = document.querySelector('#' + targetPageId + ' progress');